@@ -2,51 +2,178 @@
 Simplified authentication for OAuth testing.
 """
 
+import asyncio
 import logging
-from datetime import datetime, timedelta
+import threading
+import time
 
-from fastapi import HTTPException, Request, status
-from fastapi.security import HTTPBearer
+from cachetools import TLRUCache
+from fastapi import Depends, HTTPException, Request, status
 
 from models.database import credentials_db
 from services import AuthService
+from utils.hashing import token_key
+from utils.tokens import TOKEN_REFRESH_THRESHOLD
 
 logger = logging.getLogger(__name__)
 
-# Security scheme for Bearer token
-security = HTTPBearer(auto_error=False)
+# Session lookups are cached briefly so repeated requests with the same cookie skip Postgres
+SESSION_CACHE_TTL = 30
+SESSION_NEGATIVE_CACHE_TTL = 5
 
-def get_access_token_simple(request: Request) -> str | None:
-    """Simple access token extraction for OAuth testing."""
-    user_data = get_current_user(request)
-    if user_data:
-        return user_data.get('access_token')
-    return None
 
+def _session_ttu(_key: bytes, user_data: dict | None, now: float) -> float:
+    """Expire cached sessions after the TTL, or earlier if the session itself expires first."""
+    if user_data is None:
+        return now + SESSION_NEGATIVE_CACHE_TTL
+    remaining = user_data["session_expires_at"] - time.time()
+    return now + min(SESSION_CACHE_TTL, remaining)
 
-async def require_oauth_token(request: Request) -> str:
-    """Require OAuth access token for API calls."""
-    access_token = await get_access_token_with_refresh(request)
-    if not access_token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="OAuth authentication required. Please authenticate first.",
+
+_session_cache = TLRUCache(maxsize=10000, ttu=_session_ttu)
+_session_cache_lock = threading.RLock()
+
+
+async def _validate_session_cached(session_token: str) -> dict | None:
+    """Validate a session token, serving repeated lookups from the in-memory cache."""
+    key = token_key(session_token)
+    with _session_cache_lock:
+        try:
+            return _session_cache[key]
+        except KeyError:
+            pass
+    user_data = await credentials_db.validate_session_async(session_token)
+    with _session_cache_lock:
+        _session_cache[key] = user_data
+    return user_data
+
+
+def invalidate_cached_session(session_token: str) -> None:
+    """Drop a session from the cache, e.g. on logout or after its tokens change."""
+    with _session_cache_lock:
+        _session_cache.pop(token_key(session_token), None)
+
+
+def _update_cached_session(session_token: str, user_data: dict, new_tokens: dict) -> None:
+    """Replace a cached session's tokens with freshly refreshed ones."""
+    with _session_cache_lock:
+        _session_cache[token_key(session_token)] = {
+            **user_data,
+            "access_token": new_tokens["access_token"],
+            "refresh_token": new_tokens.get("refresh_token") or user_data["refresh_token"],
+            "token_expires_at": float(new_tokens["expires_at"]),
+        }
+
+
+# In-flight token refreshes keyed by user_id, so concurrent requests share one upstream call
+_refresh_inflight: dict[str, asyncio.Task] = {}
+# Token writes still running in the background; holding them keeps the tasks from being collected
+_pending_token_writes: set[asyncio.Task] = set()
+
+
+def _token_write_done(task: asyncio.Task) -> None:
+    _pending_token_writes.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Failed to persist refreshed tokens: %s", task.exception())
+
+
+async def _refresh_user_tokens(
+    auth_service: AuthService, user_id: str, refresh_token: str, access_token: str, force_refresh: bool
+) -> dict:
+    """Refresh a user's OAuth tokens and return them, persisting them in the background if they changed."""
+    token_cache = await credentials_db.get_token_cache_async(user_id)
+    new_tokens = await auth_service.refresh_access_token(
+        refresh_token, token_cache=token_cache, force_refresh=force_refresh
+    )
+    if new_tokens["access_token"] == access_token:
+        return new_tokens
+    # Callers get the token straight away instead of waiting on the DB write
+    write = asyncio.create_task(
+        credentials_db.update_tokens_async(
+            user_id=user_id,
+            access_token=new_tokens["access_token"],
+            refresh_token=new_tokens.get("refresh_token", refresh_token),
+            expires_in=max(int(new_tokens["expires_at"] - time.time()), 0),
+            token_cache=new_tokens.get("token_cache")
         )
-    return access_token
+    )
+    _pending_token_writes.add(write)
+    write.add_done_callback(_token_write_done)
+    return new_tokens
+
+
+def _refresh_once(
+    auth_service: AuthService, user_id: str, refresh_token: str, access_token: str, force_refresh: bool = False
+) -> asyncio.Task:
+    """Return the in-flight refresh task for a user, starting one if none is running."""
+    # No await between lookup and insert, so this check-and-set is atomic on the event loop
+    task = _refresh_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(
+            _refresh_user_tokens(auth_service, user_id, refresh_token, access_token, force_refresh)
+        )
+        _refresh_inflight[user_id] = task
+        task.add_done_callback(lambda _: _refresh_inflight.pop(user_id, None))
+    return task
 
 
-def get_current_user(request: Request) -> dict | None:
+# Background refresh: scan every minute for tokens expiring within the next ten, at most 50 users per sweep
+TOKEN_REFRESH_INTERVAL = 60
+TOKEN_REFRESH_WINDOW = 600
+TOKEN_REFRESH_BATCH = 50
+# Postgres advisory lock key, so only one uvicorn worker runs each sweep
+TOKEN_REFRESH_LOCK_KEY = 0x6F75746C6F6F6B
+
+
+async def _refresh_sweep(auth_service: AuthService) -> None:
+    """Refresh one batch of near-expiry tokens, marking users whose refresh fails so later sweeps skip them."""
+    async with credentials_db.advisory_lock_async(TOKEN_REFRESH_LOCK_KEY) as locked:
+        if not locked:
+            return
+        rows = await credentials_db.get_expiring_credentials_async(TOKEN_REFRESH_WINDOW, TOKEN_REFRESH_BATCH)
+        for row in rows:
+            try:
+                # Forced, so the sweep renews the token instead of re-reading the still-valid cached one
+                await asyncio.shield(
+                    _refresh_once(
+                        auth_service, row["user_id"], row["refresh_token"], row["access_token"], force_refresh=True
+                    )
+                )
+            except Exception as e:
+                logger.warning("Background token refresh failed for user %s: %s", row["user_id"], e)
+                await credentials_db.mark_refresh_failed_async(row["user_id"])
+
+
+async def refresh_expiring_tokens(auth_service: AuthService) -> None:
+    """Proactively refresh near-expiry tokens so requests rarely refresh inline."""
+    while True:
+        try:
+            await _refresh_sweep(auth_service)
+        except Exception as e:
+            logger.error("Background token refresh scan failed: %s", e)
+        await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+
+
+async def get_auth_service(request: Request) -> AuthService:
+    """Return the AuthService created once in the app lifespan; async so FastAPI doesn't hop to a thread for it."""
+    return request.app.state.auth_service
+
+
+async def get_current_user(request: Request) -> dict | None:
+    """Return the session user; requests without a session cookie return None before any lookup."""
     session_token = request.cookies.get("session_token")
     if not session_token:
         return None
-    user_data = credentials_db.validate_session(session_token)
+    user_data = await _validate_session_cached(session_token)
     return user_data
 
-async def get_access_token_with_refresh(request: Request) -> str | None:
+async def get_access_token_with_refresh(
+    request: Request, user_data: dict | None = Depends(get_current_user)
+) -> str | None:
     """
     Get access token for the current user, refresh if expired or near expiry.
     """
-    user_data = get_current_user(request)
+    # user_data comes through Depends so FastAPI shares one session lookup per request
     if not user_data:
         return None
     access_token = user_data.get('access_token')
@@ -55,29 +182,37 @@ async def get_access_token_with_refresh(request: Request) -> str | None:
     user_id = user_data.get('user_id')
     if not access_token or not refresh_token or not token_expires_at or not user_id:
         return None
-    # Check if token is expired or will expire in next 5 minutes
-    try:
-        expires_at = datetime.fromisoformat(token_expires_at)
-    except Exception:
-        logger.error("Invalid token_expires_at format")
-        return None
-    now = datetime.utcnow()
-    if expires_at - now < timedelta(minutes=5):
+    # Check if token is expired or will expire within the refresh threshold
+    if token_expires_at - time.time() < TOKEN_REFRESH_THRESHOLD:
         # Token expired or about to expire, refresh
-        auth_service = AuthService()
+        auth_service = request.app.state.auth_service
         try:
-            new_tokens = await auth_service.refresh_access_token(refresh_token)
-            credentials_db.update_tokens(
-                user_id=user_id,
-                access_token=new_tokens["access_token"],
-                refresh_token=new_tokens.get("refresh_token", refresh_token),
-                expires_in=3600  # or parse from new_tokens if available
-            )
+            # Shield the shared refresh so one disconnecting client doesn't cancel it for the others
+            new_tokens = await asyncio.shield(_refresh_once(auth_service, user_id, refresh_token, access_token))
+            # Update the cached session in place; the DB row may still be being written
+            _update_cached_session(request.cookies.get("session_token"), user_data, new_tokens)
             return new_tokens["access_token"]
         except Exception as e:
-            logger.error(f"Failed to refresh token: {e}")
+            logger.error("Failed to refresh token: %s", e)
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="OAuth token expired and refresh failed. Please re-authenticate."
             )
     return access_token
+
+
+async def get_access_token_simple(user_data: dict | None = Depends(get_current_user)) -> str | None:
+    """Simple access token extraction for OAuth testing."""
+    if user_data:
+        return user_data.get('access_token')
+    return None
+
+
+async def require_oauth_token(access_token: str | None = Depends(get_access_token_with_refresh)) -> str:
+    """Require OAuth access token for API calls."""
+    if not access_token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="OAuth authentication required. Please authenticate first.",
+        )
+    return access_token
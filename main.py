@@ -2,7 +2,9 @@
 Outlook Email Service API - Main FastAPI Application
 """
 
-# IMPORTANT: Suppress gevent monkey-patching warnings and patch early
+# IMPORTANT: Suppress gevent monkey-patching warnings and patch early.
+# dify_plugin calls gevent.monkey.patch_all() when imported, so the patch can't be dropped;
+# doing it here, before anything imports ssl or threading, avoids late-patching errors.
 import warnings
 
 warnings.filterwarnings("ignore", message=".*Monkey-patching ssl.*", category=Warning)
@@ -11,8 +13,9 @@ import gevent.monkey
 
 gevent.monkey.patch_all(ssl=False, subprocess=False)  # Patch selectively to avoid conflicts
 
+import asyncio
 import logging
-from datetime import datetime
+from contextlib import asynccontextmanager, suppress
 
 from dotenv import load_dotenv
 
@@ -23,15 +26,36 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
+from auth.dependencies import refresh_expiring_tokens
 from config import REDIRECT_URI, SYSTEM_CREDENTIALS
-from routers.client import client_router
+from models.pg_config import db_connection
+from providers.outlook import graph_async_client
+from routers.client import api_test_client, client_router
 from routers.email import email_router
 from routers.oauth import oauth_router
+from schemas.common_schemas import utc_timestamp
+from services import AuthService
+from tools._http import graph_breaker
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared services at startup and release them on shutdown."""
+    app.state.auth_service = AuthService()
+    refresh_task = asyncio.create_task(refresh_expiring_tokens(app.state.auth_service))
+    yield
+    refresh_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await refresh_task
+    await graph_async_client.aclose()
+    await api_test_client.aclose()
+    await db_connection.close_pool()
+
+
 # Initialize FastAPI app with metadata
 app = FastAPI(
     title="Outlook Email Service API",
@@ -39,6 +63,7 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 # Add CORS middleware
@@ -56,32 +81,41 @@ app.include_router(email_router, tags=["Email Operations"])
 app.include_router(client_router, tags=["Client Portal"])
 
 
+# Static parts of the health responses; only the timestamp changes per request
+_ROOT_BODY = {
+    "service": "Outlook Email Service API",
+    "status": "healthy",
+    "version": "1.0.0",
+    "endpoints": {"docs": "/docs", "redoc": "/redoc", "oauth": "/oauth", "emails": "/emails", "client": "/client"},
+}
+_HEALTH_BODY = {
+    "status": "healthy",
+    "service": "Outlook Email Service API",
+    "version": "1.0.0",
+    "components": {"oauth": "operational", "email_service": "operational", "microsoft_graph": "operational"},
+    "configuration": {
+        "redirect_uri": REDIRECT_URI,
+        "client_configured": bool(SYSTEM_CREDENTIALS.get("client_id")),
+        "tenant_id": SYSTEM_CREDENTIALS.get("tenant_id", "common"),
+    },
+}
+
+
 @app.get("/", summary="Health Check")
-async def root():
+async def root() -> dict:
     """Health check endpoint."""
-    return {
-        "service": "Outlook Email Service API",
-        "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat() + "Z",
-        "version": "1.0.0",
-        "endpoints": {"docs": "/docs", "redoc": "/redoc", "oauth": "/oauth", "emails": "/emails", "client": "/client"},
-    }
+    return {**_ROOT_BODY, "timestamp": utc_timestamp()}
 
 
 @app.get("/health", summary="Detailed Health Check")
-async def health_check():
+async def health_check() -> dict:
     """Detailed health check with system information."""
+    # An open breaker means recent Graph calls from the tools kept failing and are being short-circuited
+    graph_status = "operational" if graph_breaker.current_state == "closed" else "degraded"
     return {
-        "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat() + "Z",
-        "service": "Outlook Email Service API",
-        "version": "1.0.0",
-        "components": {"oauth": "operational", "email_service": "operational", "microsoft_graph": "operational"},
-        "configuration": {
-            "redirect_uri": REDIRECT_URI,
-            "client_configured": bool(SYSTEM_CREDENTIALS.get("client_id")),
-            "tenant_id": SYSTEM_CREDENTIALS.get("tenant_id", "common"),
-        },
+        **_HEALTH_BODY,
+        "components": {**_HEALTH_BODY["components"], "microsoft_graph": graph_status},
+        "timestamp": utc_timestamp(),
     }
 
 
@@ -89,13 +123,13 @@ async def health_check():
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """Global exception handler for unhandled errors."""
-    logger.error(f"Unhandled exception: {exc}")
+    logger.error("Unhandled exception: %s", exc)
     return JSONResponse(
         status_code=500,
         content={
             "error": "Internal server error",
             "message": "An unexpected error occurred",
-            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "timestamp": utc_timestamp(),
         },
     )
 
@@ -112,7 +146,12 @@ def main():
     logger.info("- OAuth Authorization: http://localhost:8000/oauth/authorize")
     logger.info("- Email Operations: http://localhost:8000/emails")
 
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True, log_level="info")
+    # The stdlib asyncio loop, not uvloop: with gevent patching threading, worker "threads" are greenlets that only
+    # run when the gevent hub gets control, which never happens while uvloop blocks in libuv. That deadlocks every
+    # asyncio.to_thread / Starlette threadpool hop; asyncio's selector goes through gevent's select and doesn't.
+    uvicorn.run(
+        "main:app", host="0.0.0.0", port=8000, reload=True, log_level="info", loop="asyncio", http="httptools"
+    )
 
 
 if __name__ == "__main__":
@@ -2,22 +2,31 @@
 Database models for user authentication and credential storage using PostgreSQL.
 """
 
+import atexit
+import base64
 import logging
 import os
 import secrets
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, contextmanager
+from datetime import UTC, datetime, timedelta
 from typing import Dict, List, Optional  # noqa: UP035
 
 try:
     import asyncpg
     import psycopg2
+    import psycopg2.pool
+    from psycopg2.extensions import connection as pg_connection
     from psycopg2.extras import RealDictCursor
+
+    from models.pg_config import get_db_pool
     POSTGRES_AVAILABLE = True
 except ImportError:
     POSTGRES_AVAILABLE = False
     asyncpg = None
     psycopg2 = None
     RealDictCursor = None
+    pg_connection = object
+    get_db_pool = None
 
 logger = logging.getLogger(__name__)
 
@@ -33,11 +42,96 @@ DATABASE_CONFIG = {
 DATABASE_URL = f"postgresql://{DATABASE_CONFIG['user']}:{DATABASE_CONFIG['password']}@{DATABASE_CONFIG['host']}:{DATABASE_CONFIG['port']}/{DATABASE_CONFIG['database']}"
 
 
+# Hot-path queries, written with $n placeholders so the same text serves both the
+# server-side PREPAREd psycopg2 statements and asyncpg's per-connection statement cache
+VALIDATE_SESSION_SQL = """
+    SELECT s.user_id, s.expires_at, u.email, u.display_name, u.access_token, u.refresh_token, u.token_expires_at
+    FROM user_sessions s
+    JOIN user_credentials u ON s.user_id = u.user_id
+    WHERE s.session_token = $1 AND s.is_active = TRUE AND u.is_active = TRUE
+"""
+
+# Looks the key up and stamps last_used_at in the same statement
+VALIDATE_API_KEY_SQL = """
+    UPDATE api_keys a SET last_used_at = CURRENT_TIMESTAMP
+    FROM user_credentials u
+    WHERE a.api_key = $1 AND a.user_id = u.user_id AND a.is_active = TRUE AND u.is_active = TRUE
+    RETURNING a.user_id, u.email, u.display_name, u.access_token, u.token_expires_at, u.refresh_token
+"""
+
+# Upserts the user's credentials and opens a session for them in one statement
+SAVE_CREDENTIALS_AND_SESSION_SQL = """
+    WITH u AS (
+        INSERT INTO user_credentials
+        (user_id, email, display_name, access_token, refresh_token, token_expires_at, token_cache, updated_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET
+            email = EXCLUDED.email,
+            display_name = EXCLUDED.display_name,
+            access_token = EXCLUDED.access_token,
+            refresh_token = EXCLUDED.refresh_token,
+            token_expires_at = EXCLUDED.token_expires_at,
+            token_cache = EXCLUDED.token_cache,
+            refresh_failed_at = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING user_id
+    )
+    INSERT INTO user_sessions (session_token, user_id, expires_at)
+    SELECT $8, u.user_id, $9 FROM u
+"""
+
+PREPARED_STATEMENTS = {
+    "validate_session": f"PREPARE validate_session(text) AS {VALIDATE_SESSION_SQL}",
+    "validate_api_key": f"PREPARE validate_api_key(text) AS {VALIDATE_API_KEY_SQL}",
+    "save_credentials_and_session": (
+        "PREPARE save_credentials_and_session(text, text, text, text, text, timestamp, text, text, timestamp) "
+        f"AS {SAVE_CREDENTIALS_AND_SESSION_SQL}"
+    ),
+}
+
+
+class PreparedConnection(pg_connection):
+    """psycopg2 connection that remembers whether the hot-path statements were prepared on it."""
+    statements_prepared = False
+
+
+def _rand_token(nbytes: int) -> str:
+    """Return a URL-safe random token carrying nbytes of entropy."""
+    return base64.urlsafe_b64encode(secrets.token_bytes(nbytes)).rstrip(b"=").decode("ascii")
+
+
+def _epoch(value: datetime | None) -> float | None:
+    """Convert a naive UTC timestamp column to epoch seconds."""
+    return value.replace(tzinfo=UTC).timestamp() if value else None
+
+
+def _session_user(row) -> dict:
+    """Build the user dict returned by session validation from a psycopg2 or asyncpg row."""
+    return {
+        'user_id': row['user_id'],
+        'email': row['email'],
+        'display_name': row['display_name'],
+        'access_token': row['access_token'],
+        'refresh_token': row['refresh_token'],
+        'token_expires_at': _epoch(row['token_expires_at']),
+        'session_expires_at': _epoch(row['expires_at'])
+    }
+
+
 class UserCredentialsDB:
     """Database manager for user credentials and authentication using PostgreSQL."""
     def __init__(self):
         self.pool = None
         self.init_database()
+        # Keep connections open across requests instead of reconnecting on every call
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=2,
+            maxconn=20,
+            connection_factory=PreparedConnection,
+            cursor_factory=RealDictCursor,
+            **DATABASE_CONFIG
+        )
+        atexit.register(self.pool.closeall)
     def init_database(self):
         """Initialize the database with required tables."""
         if not POSTGRES_AVAILABLE:
@@ -63,11 +157,16 @@ class UserCredentialsDB:
                         access_token TEXT NOT NULL,
                         refresh_token TEXT,
                         token_expires_at TIMESTAMP NOT NULL,
+                        token_cache TEXT,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         is_active BOOLEAN DEFAULT TRUE
                     )
                 """)
+                # Serialized MSAL token cache, added after the initial schema
+                cursor.execute("ALTER TABLE user_credentials ADD COLUMN IF NOT EXISTS token_cache TEXT")
+                # Set when a background refresh fails, so the sweep skips the user until their tokens change
+                cursor.execute("ALTER TABLE user_credentials ADD COLUMN IF NOT EXISTS refresh_failed_at TIMESTAMP")
                 # Create user_sessions table
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS user_sessions (
@@ -97,24 +196,46 @@ class UserCredentialsDB:
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON user_credentials(user_id)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_token ON user_sessions(session_token)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_key ON api_keys(api_key)")
+                # Partial covering indexes for the session / API key validation lookups
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_session_active ON user_sessions(session_token)
+                    INCLUDE (user_id, expires_at) WHERE is_active = TRUE
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_api_key_active ON api_keys(api_key)
+                    INCLUDE (user_id) WHERE is_active = TRUE
+                """)
+                # Token columns stay out of this index: OAuth tokens can exceed the btree tuple size limit
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_user_active ON user_credentials(user_id)
+                    INCLUDE (email, display_name, token_expires_at) WHERE is_active = TRUE
+                """)
                 conn.commit()
                 logger.info("PostgreSQL database schema initialized successfully")
         except Exception as e:
-            logger.error(f"Failed to initialize PostgreSQL database: {e}")
+            logger.error("Failed to initialize PostgreSQL database: %s", e)
             raise
         finally:
             if conn:
                 conn.close()
+    @contextmanager
     def _get_connection(self):
-        """Get a synchronous database connection."""
-        return psycopg2.connect(
-            host=DATABASE_CONFIG["host"],
-            port=DATABASE_CONFIG["port"],
-            database=DATABASE_CONFIG["database"],
-            user=DATABASE_CONFIG["user"],
-            password=DATABASE_CONFIG["password"],
-            cursor_factory=RealDictCursor
-        )
+        """Borrow a pooled database connection, committing or rolling back on exit."""
+        conn = self.pool.getconn()
+        try:
+            if not conn.statements_prepared:
+                self._prepare_statements(conn)
+            with conn:
+                yield conn
+        finally:
+            self.pool.putconn(conn)
+    def _prepare_statements(self, conn):
+        """PREPARE the hot-path statements once per pooled connection so Postgres plans them once."""
+        with conn.cursor() as cursor:
+            for statement in PREPARED_STATEMENTS.values():
+                cursor.execute(statement)
+        conn.commit()
+        conn.statements_prepared = True
     def save_user_credentials(self, user_info: dict, tokens: dict) -> str:
         """Save user credentials after OAuth exchange."""
         user_id = user_info.get('id') or user_info.get('userPrincipalName', '').split('@')[0]
@@ -125,14 +246,16 @@ class UserCredentialsDB:
             with conn.cursor() as cursor:
                 cursor.execute("""
                     INSERT INTO user_credentials
-                    (user_id, email, display_name, access_token, refresh_token, token_expires_at, updated_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                    (user_id, email, display_name, access_token, refresh_token, token_expires_at, token_cache, updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
                     ON CONFLICT (user_id) DO UPDATE SET
                         email = EXCLUDED.email,
                         display_name = EXCLUDED.display_name,
                         access_token = EXCLUDED.access_token,
                         refresh_token = EXCLUDED.refresh_token,
                         token_expires_at = EXCLUDED.token_expires_at,
+                        token_cache = EXCLUDED.token_cache,
+                        refresh_failed_at = NULL,
                         updated_at = CURRENT_TIMESTAMP
                 """, (
                     user_id,
@@ -140,14 +263,58 @@ class UserCredentialsDB:
                     display_name,
                     tokens['access_token'],
                     tokens.get('refresh_token'),
-                    expires_at
+                    expires_at,
+                    tokens.get('token_cache')
                 ))
                 conn.commit()
-        logger.info(f"Saved credentials for user: {email}")
+        logger.info("Saved credentials for user: %s", email)
         return user_id
+    @staticmethod
+    def _credentials_and_session_params(user_info: dict, tokens: dict, duration_hours: int) -> tuple:
+        """Build the parameters shared by the sync and async credential/session upserts."""
+        user_id = user_info.get('id') or user_info.get('userPrincipalName', '').split('@')[0]
+        email = user_info.get('mail') or user_info.get('userPrincipalName', '')
+        display_name = user_info.get('displayName', '')
+        expires_at = datetime.utcnow() + timedelta(seconds=tokens.get('expires_in', 3600))
+        session_token = _rand_token(32)
+        session_expires_at = datetime.utcnow() + timedelta(hours=duration_hours)
+        return (
+            user_id,
+            email,
+            display_name,
+            tokens['access_token'],
+            tokens.get('refresh_token'),
+            expires_at,
+            tokens.get('token_cache'),
+            session_token,
+            session_expires_at
+        )
+    def save_credentials_and_session(
+        self, user_info: dict, tokens: dict, duration_hours: int = 24
+    ) -> tuple[str, str]:
+        """Save user credentials and create a session in a single round-trip."""
+        params = self._credentials_and_session_params(user_info, tokens, duration_hours)
+        with self._get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "EXECUTE save_credentials_and_session(%s, %s, %s, %s, %s, %s, %s, %s, %s)", params
+                )
+                conn.commit()
+        logger.info("Saved credentials and created session for user: %s", params[1])
+        return params[0], params[7]
+    async def save_credentials_and_session_async(
+        self, user_info: dict, tokens: dict, duration_hours: int = 24
+    ) -> tuple[str, str]:
+        """Save user credentials and create a session using the asyncpg pool."""
+        params = self._credentials_and_session_params(user_info, tokens, duration_hours)
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(SAVE_CREDENTIALS_AND_SESSION_SQL, *params)
+        logger.info("Saved credentials and created session for user: %s", params[1])
+        return params[0], params[7]
     def create_session(self, user_id: str, duration_hours: int = 24) -> str:
         """Create a new session token for a user."""
-        session_token = secrets.token_urlsafe(32)
+        session_token = _rand_token(32)
         expires_at = datetime.utcnow() + timedelta(hours=duration_hours)
         with self._get_connection() as conn:
             with conn.cursor() as cursor:
@@ -156,18 +323,13 @@ class UserCredentialsDB:
                     VALUES (%s, %s, %s)
                 """, (session_token, user_id, expires_at))
                 conn.commit()
-        logger.info(f"Created session for user: {user_id}")
+        logger.info("Created session for user: %s", user_id)
         return session_token
     def validate_session(self, session_token: str) -> dict | None:
         """Validate a session token and return user info."""
         with self._get_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT s.user_id, s.expires_at, u.email, u.display_name, u.access_token, u.refresh_token, u.token_expires_at
-                    FROM user_sessions s
-                    JOIN user_credentials u ON s.user_id = u.user_id
-                    WHERE s.session_token = %s AND s.is_active = TRUE AND u.is_active = TRUE
-                """, (session_token,))
+                cursor.execute("EXECUTE validate_session(%s)", (session_token,))
                 row = cursor.fetchone()
                 if not row:
                     return None
@@ -175,17 +337,25 @@ class UserCredentialsDB:
                 if row['expires_at'] < datetime.utcnow():
                     self.invalidate_session(session_token)
                     return None
-                return {
-                    'user_id': row['user_id'],
-                    'email': row['email'],
-                    'display_name': row['display_name'],
-                    'access_token': row['access_token'],
-                    'refresh_token': row['refresh_token'],
-                    'token_expires_at': row['token_expires_at'].isoformat() if row['token_expires_at'] else None
-                }
+                return _session_user(row)
+    async def validate_session_async(self, session_token: str) -> dict | None:
+        """Validate a session token on the asyncpg pool without blocking the event loop."""
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(VALIDATE_SESSION_SQL, session_token)
+            if not row:
+                return None
+            # Check if session is expired
+            if row['expires_at'] < datetime.utcnow():
+                await conn.execute("""
+                    UPDATE user_sessions SET is_active = FALSE
+                    WHERE session_token = $1
+                """, session_token)
+                return None
+            return _session_user(row)
     def generate_api_key(self, user_id: str, name: str = "Default") -> str:
         """Generate a new API key for a user."""
-        api_key = f"ok_{secrets.token_urlsafe(40)}"
+        api_key = f"ok_{_rand_token(40)}"
         with self._get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("""
@@ -193,34 +363,26 @@ class UserCredentialsDB:
                     VALUES (%s, %s, %s)
                 """, (api_key, user_id, name))
                 conn.commit()
-        logger.info(f"Generated API key for user: {user_id}")
+        logger.info("Generated API key for user: %s", user_id)
         return api_key
     def validate_api_key(self, api_key: str) -> dict | None:
         """Validate an API key and return user credentials."""
         with self._get_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT a.user_id, u.email, u.display_name, u.access_token, u.token_expires_at, u.refresh_token
-                    FROM api_keys a
-                    JOIN user_credentials u ON a.user_id = u.user_id
-                    WHERE a.api_key = %s AND a.is_active = TRUE AND u.is_active = TRUE
-                """, (api_key,))
+                # last_used_at is telemetry, so don't make the caller wait on the WAL fsync
+                cursor.execute("SET LOCAL synchronous_commit = off")
+                cursor.execute("EXECUTE validate_api_key(%s)", (api_key,))
                 row = cursor.fetchone()
+                conn.commit()
                 if not row:
                     return None
-                # Update last used timestamp
-                cursor.execute("""
-                    UPDATE api_keys SET last_used_at = CURRENT_TIMESTAMP
-                    WHERE api_key = %s
-                """, (api_key,))
-                conn.commit()
                 return {
                     'user_id': row['user_id'],
                     'email': row['email'],
                     'display_name': row['display_name'],
                     'access_token': row['access_token'],
                     'refresh_token': row['refresh_token'],
-                    'token_expires_at': row['token_expires_at'].isoformat() if row['token_expires_at'] else None
+                    'token_expires_at': _epoch(row['token_expires_at'])
                 }
     def get_user_credentials(self, user_id: str) -> dict | None:
         """Get user credentials by user ID."""
@@ -242,16 +404,73 @@ class UserCredentialsDB:
                 if refresh_token:
                     cursor.execute("""
                         UPDATE user_credentials
-                        SET access_token = %s, refresh_token = %s, token_expires_at = %s, updated_at = CURRENT_TIMESTAMP
+                        SET access_token = %s, refresh_token = %s, token_expires_at = %s, refresh_failed_at = NULL,
+                            updated_at = CURRENT_TIMESTAMP
                         WHERE user_id = %s
                     """, (access_token, refresh_token, expires_at, user_id))
                 else:
                     cursor.execute("""
                         UPDATE user_credentials
-                        SET access_token = %s, token_expires_at = %s, updated_at = CURRENT_TIMESTAMP
+                        SET access_token = %s, token_expires_at = %s, refresh_failed_at = NULL, updated_at = CURRENT_TIMESTAMP
                         WHERE user_id = %s
                     """, (access_token, expires_at, user_id))
                 conn.commit()
+    async def update_tokens_async(
+        self, user_id: str, access_token: str, refresh_token: str = None, expires_in: int = 3600,
+        token_cache: str = None
+    ):
+        """Update user tokens after refresh using the asyncpg pool."""
+        expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE user_credentials
+                SET access_token = $1, refresh_token = COALESCE($2, refresh_token),
+                    token_expires_at = $3, token_cache = COALESCE($5, token_cache),
+                    refresh_failed_at = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = $4
+            """, access_token, refresh_token, expires_at, user_id, token_cache)
+    async def get_expiring_credentials_async(self, within_seconds: int, limit: int) -> list[dict]:
+        """Get up to limit active users whose still-valid access token expires within the given seconds."""
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            # Already-expired tokens and users whose last background refresh failed are left to the request path
+            rows = await conn.fetch("""
+                SELECT user_id, access_token, refresh_token FROM user_credentials
+                WHERE is_active = TRUE AND refresh_token IS NOT NULL AND refresh_failed_at IS NULL
+                AND token_expires_at > (NOW() AT TIME ZONE 'UTC')
+                AND token_expires_at < (NOW() AT TIME ZONE 'UTC') + make_interval(secs => $1)
+                ORDER BY token_expires_at
+                LIMIT $2
+            """, within_seconds, limit)
+        return [dict(row) for row in rows]
+    async def mark_refresh_failed_async(self, user_id: str):
+        """Record a failed background refresh so the sweep stops retrying the user."""
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE user_credentials SET refresh_failed_at = CURRENT_TIMESTAMP
+                WHERE user_id = $1
+            """, user_id)
+    @asynccontextmanager
+    async def advisory_lock_async(self, key: int):
+        """Hold a Postgres advisory lock for the block if no other process has it; yields whether it was taken."""
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            locked = await conn.fetchval("SELECT pg_try_advisory_lock($1)", key)
+            try:
+                yield locked
+            finally:
+                if locked:
+                    await conn.execute("SELECT pg_advisory_unlock($1)", key)
+    async def get_token_cache_async(self, user_id: str) -> str | None:
+        """Get the serialized MSAL token cache stored for a user."""
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetchval("""
+                SELECT token_cache FROM user_credentials
+                WHERE user_id = $1 AND is_active = TRUE
+            """, user_id)
     def invalidate_session(self, session_token: str):
         """Invalidate a session token."""
         with self._get_connection() as conn:
@@ -261,6 +480,14 @@ class UserCredentialsDB:
                     WHERE session_token = %s
                 """, (session_token,))
                 conn.commit()
+    async def invalidate_session_async(self, session_token: str):
+        """Invalidate a session token on the asyncpg pool."""
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE user_sessions SET is_active = FALSE
+                WHERE session_token = $1
+            """, session_token)
     def revoke_api_key(self, api_key: str):
         """Revoke an API key."""
         with self._get_connection() as conn:
@@ -280,7 +507,7 @@ class UserCredentialsDB:
                     WHERE user_id = %s
                     ORDER BY created_at DESC
                 """, (user_id,))
-                return [dict(row) for row in cursor.fetchall()]
+                return cursor.fetchall()
 
 
 # Global database instance
@@ -17,7 +17,7 @@ DATABASE_CONFIG = {
     "port": int(os.getenv("POSTGRES_PORT", "5432")),
     "database": os.getenv("POSTGRES_DB", "outlook_api"),
     "user": os.getenv("POSTGRES_USER", "postgres"),
-    "password": os.getenv("POSTGRES_PASSWORD", "password")
+    "password": os.getenv("POSTGRES_PASSWORD", "password123")
 }
 
 # Connection URL for asyncpg
@@ -41,7 +41,7 @@ class DatabaseConnection:
             )
             logger.info("PostgreSQL connection pool initialized")
         except Exception as e:
-            logger.error(f"Failed to initialize PostgreSQL pool: {e}")
+            logger.error("Failed to initialize PostgreSQL pool: %s", e)
             raise
     
     async def close_pool(self):
@@ -1,55 +1,178 @@
-import json
+import asyncio
+import atexit
+import functools
 import os
+import threading
 import time
-import urllib.error
-import urllib.parse
-import urllib.request
 from collections.abc import Mapping
 from typing import Any
 
+import httpx
+from cachetools import TLRUCache, TTLCache
 from dify_plugin import ToolProvider
 from dify_plugin.entities.oauth import ToolOAuthCredentials
 from dify_plugin.errors.tool import ToolProviderCredentialValidationError
-from msal import ConfidentialClientApplication
+from msal import ConfidentialClientApplication, SerializableTokenCache
+
+from utils.hashing import token_key
+from utils.tokens import TOKEN_REFRESH_THRESHOLD, token_exp, validated_ttu
+
+# App registration settings are fixed for the life of the process, so read them once
+_CLIENT_ID = os.getenv("AZURE_CLIENT_ID")
+_CLIENT_SECRET = os.getenv("AZURE_CLIENT_SECRET")
+
+# Shared by every MSAL application below so tenant discovery is only fetched once per process
+_msal_http_cache: dict = {}
+
+# Keep-alive HTTP/2 client reused across credential validations
+_graph_client = httpx.Client(http2=True, timeout=30, limits=httpx.Limits(max_keepalive_connections=20))
+atexit.register(_graph_client.close)
+
+# Async counterpart shared by the FastAPI request path; closed from the app lifespan
+graph_async_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(30, connect=5),
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+)
+
+GRAPH_ME_URL = "https://graph.microsoft.com/v1.0/me"
+
+# Tokens Graph rejected with a 401 are refused without a call for a few seconds; other failures aren't cached
+REJECTION_CACHE_TTL = 5
+# Async validations older than this are still served, but re-checked with Graph in the background
+VALIDATION_REVALIDATE_AFTER = 60
+
+
+# Tokens Graph accepted recently, keyed by token_key digest and expired by validated_ttu.
+# Values are (exp claim, monotonic time validated)
+_valid_token_cache: TLRUCache = TLRUCache(maxsize=10_000, ttu=validated_ttu)
+_rejected_token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=REJECTION_CACHE_TTL)
+_valid_token_cache_lock = threading.Lock()
+# Background revalidations in flight, keyed like the cache so each token is re-checked once at a time
+_revalidations: dict[bytes, asyncio.Task] = {}
+
+# Refreshed credentials keyed by the refresh token's token_key digest, reused until they enter the refresh threshold
+
+
+def _refreshed_ttu(_key: bytes, credentials: ToolOAuthCredentials, now: float) -> float:
+    """Expire cached credentials TOKEN_REFRESH_THRESHOLD seconds before the access token does."""
+    return now + credentials.expires_at - TOKEN_REFRESH_THRESHOLD - time.time()
+
+
+_refreshed_credentials: TLRUCache = TLRUCache(maxsize=10_000, ttu=_refreshed_ttu)
+_refreshed_credentials_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=16)
+def _authorization_url(redirect_uri: str, scopes: tuple[str, ...]) -> str:
+    """Build the MSAL authorization URL once per redirect URI; no state is added, so it never varies."""
+    return OutlookProvider.client.get_authorization_request_url(scopes=list(scopes), redirect_uri=redirect_uri)
 
 
 class OutlookProvider(ToolProvider):
     _SCOPES = ["User.Read", "Mail.Read", "Mail.Send", "Mail.ReadWrite"]
     client = ConfidentialClientApplication(
-        client_id=os.getenv("AZURE_CLIENT_ID"), client_credential=os.getenv("AZURE_CLIENT_SECRET")
+        client_id=_CLIENT_ID,
+        client_credential=_CLIENT_SECRET,
+        http_cache=_msal_http_cache,
     )
 
-    def _validate_credentials(self, credentials: dict[str, Any]) -> None:
-        """Validate access token by calling Microsoft Graph API."""
+    def _build_client(self, token_cache: SerializableTokenCache) -> ConfidentialClientApplication:
+        """Build an MSAL application bound to a single user's token cache."""
+        return ConfidentialClientApplication(
+            client_id=_CLIENT_ID,
+            client_credential=_CLIENT_SECRET,
+            token_cache=token_cache,
+            http_cache=_msal_http_cache,
+            # Reuse the shared application's pooled session for the token endpoint
+            http_client=self.client.http_client,
+        )
+
+    @staticmethod
+    def _cached_validation(credentials: dict[str, Any]) -> tuple[bytes, float | None]:
+        """Return the token's cache key and when it was last validated, or None if it isn't cached."""
         if not credentials.get("access_token"):
             raise ToolProviderCredentialValidationError("Microsoft Graph access token is required.")
 
-        # Create request with authentication header
-        req = urllib.request.Request(
-            "https://graph.microsoft.com/v1.0/me", headers={"Authorization": f"Bearer {credentials['access_token']}"}
-        )
+        token_hash = token_key(credentials["access_token"])
+        with _valid_token_cache_lock:
+            entry = _valid_token_cache.get(token_hash)
+            if entry is not None:
+                return token_hash, entry[1]
+            if token_hash in _rejected_token_cache:
+                raise ToolProviderCredentialValidationError("Invalid or expired access token.")
+        return token_hash, None
+
+    @staticmethod
+    def _check_validation_response(response: httpx.Response, token_hash: bytes, access_token: str) -> None:
+        """Raise for a rejected token, otherwise remember it as valid."""
+        if response.status_code == 401:
+            with _valid_token_cache_lock:
+                _valid_token_cache.pop(token_hash, None)
+                _rejected_token_cache[token_hash] = True
+            raise ToolProviderCredentialValidationError("Invalid or expired access token.")
+        if response.status_code != 200:
+            raise ToolProviderCredentialValidationError(
+                f"Failed to validate credentials: HTTP {response.status_code}"
+            )
 
+        with _valid_token_cache_lock:
+            _valid_token_cache[token_hash] = (token_exp(access_token), time.monotonic())
+
+    @staticmethod
+    async def _revalidate(token_hash: bytes, access_token: str) -> None:
+        """Re-check a cached token with Graph; a 401 evicts it so the next request fails closed."""
         try:
-            with urllib.request.urlopen(req, timeout=30) as response:
-                if response.getcode() != 200:
-                    raise ToolProviderCredentialValidationError("Invalid or expired access token.")
-        except urllib.error.HTTPError as e:
-            if e.code == 401:
-                raise ToolProviderCredentialValidationError("Invalid or expired access token.")
-            else:
-                raise ToolProviderCredentialValidationError(f"Failed to validate credentials: {e}")
-        except Exception as e:
+            response = await graph_async_client.get(GRAPH_ME_URL, headers={"Authorization": f"Bearer {access_token}"})
+            OutlookProvider._check_validation_response(response, token_hash, access_token)
+        except (httpx.HTTPError, ToolProviderCredentialValidationError):
+            # Outages leave the entry in place until its TTL; a 401 was already evicted by _check_validation_response
+            pass
+
+    def _validate_credentials(self, credentials: dict[str, Any]) -> None:
+        """Validate access token by calling Microsoft Graph API."""
+        token_hash, validated_at = self._cached_validation(credentials)
+        if validated_at is not None:
+            return
+
+        try:
+            response = _graph_client.get(
+                GRAPH_ME_URL, headers={"Authorization": f"Bearer {credentials['access_token']}"}
+            )
+        except httpx.HTTPError as e:
             raise ToolProviderCredentialValidationError(f"Network error during validation: {e}")
 
+        self._check_validation_response(response, token_hash, credentials["access_token"])
+
+    async def _validate_credentials_async(self, credentials: dict[str, Any]) -> None:
+        """Validate access token without blocking the event loop."""
+        token_hash, validated_at = self._cached_validation(credentials)
+        if validated_at is not None:
+            # Serve the cached result; if it's getting old, re-check it with Graph off the request path
+            if time.monotonic() - validated_at > VALIDATION_REVALIDATE_AFTER and token_hash not in _revalidations:
+                task = asyncio.create_task(self._revalidate(token_hash, credentials["access_token"]))
+                _revalidations[token_hash] = task
+                task.add_done_callback(lambda _: _revalidations.pop(token_hash, None))
+            return
+
+        try:
+            response = await graph_async_client.get(
+                GRAPH_ME_URL, headers={"Authorization": f"Bearer {credentials['access_token']}"}
+            )
+        except httpx.HTTPError as e:
+            raise ToolProviderCredentialValidationError(f"Network error during validation: {e}")
+
+        self._check_validation_response(response, token_hash, credentials["access_token"])
+
     def _oauth_get_authorization_url(self, redirect_uri: str) -> str:
         """Generate OAuth authorization URL."""
         # tenant_id = system_credentials.get("tenant_id", "common")
         # auth_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/authorize"
 
-        authorization_url = self.client.get_authorization_request_url(
-            scopes=self._SCOPES,
+        authorization_url = _authorization_url(
             # redirect_uri="https://cloud.dify.ai/console/api/oauth/plugin/langgenius/outlook/outlook/tool/callback",
-            redirect_uri=os.getenv("REDIRECT_URI", redirect_uri),
+            os.getenv("REDIRECT_URI", redirect_uri),
+            tuple(self._SCOPES),
         )
         if not authorization_url:
             raise ToolProviderCredentialValidationError("Failed to generate authorization URL.")
@@ -64,7 +187,8 @@ class OutlookProvider(ToolProvider):
         if not code:
             raise ToolProviderCredentialValidationError("No authorization code provided")
 
-        credentials = self.client.acquire_token_by_authorization_code(
+        token_cache = SerializableTokenCache()
+        credentials = self._build_client(token_cache).acquire_token_by_authorization_code(
             code=code, scopes=self._SCOPES, redirect_uri=os.getenv("REDIRECT_URI", redirect_uri)
         )
 
@@ -75,29 +199,67 @@ class OutlookProvider(ToolProvider):
             raise ToolProviderCredentialValidationError("Failed to obtain refresh token from authorization code.")
 
         return ToolOAuthCredentials(
-            credentials={"access_token": credentials["access_token"], "refresh_token": credentials["refresh_token"]},
+            credentials={
+                "access_token": credentials["access_token"],
+                "refresh_token": credentials["refresh_token"],
+                "token_cache": token_cache.serialize(),
+            },
             expires_at=credentials.get("expires_in", 3599) + int(time.time()),
         )
 
     def oauth_refresh_credentials(
-        self, credentials: Mapping[str, Any]
+        self, credentials: Mapping[str, Any], *, force_refresh: bool = False
     ) -> ToolOAuthCredentials:
-        """Refresh OAuth credentials."""
-        refreshed_credentials = self.client.acquire_token_by_refresh_token(
-            refresh_token=credentials.get("refresh_token"),
-            scopes=self._SCOPES,
-        )
+        """
+        Refresh OAuth credentials, serving still-valid tokens from the user's MSAL cache.
+        force_refresh skips both caches and always redeems the refresh token for a new access token.
+        """
+        cache_key = token_key(credentials.get("refresh_token") or "")
+        if not force_refresh:
+            with _refreshed_credentials_lock:
+                cached = _refreshed_credentials.get(cache_key)
+            if cached is not None:
+                return cached
+
+        token_cache = SerializableTokenCache()
+        if credentials.get("token_cache"):
+            token_cache.deserialize(credentials["token_cache"])
+        client = self._build_client(token_cache)
+
+        # A cached access token with more than the refresh threshold left avoids a round-trip to the token
+        # endpoint; one inside it would only send the caller straight back here, so it forces a real grant
+        refreshed_credentials = None
+        accounts = [] if force_refresh else client.get_accounts()
+        if accounts:
+            refreshed_credentials = client.acquire_token_silent(self._SCOPES, account=accounts[0])
+        if (
+            not refreshed_credentials
+            or "access_token" not in refreshed_credentials
+            or refreshed_credentials.get("expires_in", 0) <= TOKEN_REFRESH_THRESHOLD
+        ):
+            refreshed_credentials = client.acquire_token_by_refresh_token(
+                refresh_token=credentials.get("refresh_token"),
+                scopes=self._SCOPES,
+            )
 
         access_token = refreshed_credentials.get("access_token")
-        refresh_token = refreshed_credentials.get("refresh_token")
+        # Silent acquisition doesn't return the refresh token, so keep the one we have
+        refresh_token = refreshed_credentials.get("refresh_token") or credentials.get("refresh_token")
 
         if not access_token or not refresh_token:
             raise ToolProviderCredentialValidationError("No access token or refresh token in response")
 
-        return ToolOAuthCredentials(
-            credentials={"access_token": access_token, "refresh_token": refresh_token},
+        oauth_credentials = ToolOAuthCredentials(
+            credentials={
+                "access_token": access_token,
+                "refresh_token": refresh_token,
+                "token_cache": token_cache.serialize() if token_cache.has_state_changed else credentials.get("token_cache"),
+            },
             expires_at=refreshed_credentials.get("expires_in", 3599) + int(time.time()),
         )
+        with _refreshed_credentials_lock:
+            _refreshed_credentials[cache_key] = oauth_credentials
+        return oauth_credentials
 
 
 outlook_provider = OutlookProvider()
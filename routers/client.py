@@ -2,22 +2,26 @@
 Client portal router for server-side rendering of OAuth authentication UI.
 Provides a web interface for users to authenticate and get credentials.
 """
-from datetime import datetime
+import time
+from datetime import UTC, datetime
 
 import httpx
-from fastapi import APIRouter, Form, HTTPException, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, Form, HTTPException, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 
-from auth.dependencies import get_current_user
+from auth.dependencies import get_auth_service, get_current_user, invalidate_cached_session
+from config import SYSTEM_CREDENTIALS
 from models.database import credentials_db
 from providers.outlook import outlook_provider
-from services.auth_service import AuthService
+from services import AuthService
+from utils.handlers import graph_endpoint
 
-# Initialize router, templates, and services
+# Initialize router and templates
 client_router = APIRouter(prefix="/client", tags=["Client Portal"])
 templates = Jinja2Templates(directory="templates")
-auth_service = AuthService()
+# Pooled client for the API testing console; closed from the app lifespan
+api_test_client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_keepalive_connections=20))
 
 
 # Remove the old session management functions since we're using database now
@@ -27,56 +31,52 @@ def get_base_url(request: Request) -> str:
 
 
 @client_router.get("/", response_class=HTMLResponse, summary="Client Portal Homepage")
-async def client_portal(request: Request):
+@graph_endpoint("Error loading client portal")
+async def client_portal(request: Request, user: dict | None = Depends(get_current_user)):
     """
     Main client portal page for OAuth authentication.
     """
-    try:
-        user = get_current_user(request)
-        authenticated = user is not None
-        access_token = None
-        user_info = {}
-        token_expires = None
-
-        if authenticated:
-            access_token = user.get("access_token")
-            user_info = {
-                "email": user.get("email"),
-                "name": user.get("display_name")
-            }
-            # Format token expiration
-            if user.get("token_expires_at"):
-                expires_at = datetime.fromisoformat(user["token_expires_at"])
-                token_expires = expires_at.strftime("%Y-%m-%d %H:%M:%S")
-        # Get authorization URL for non-authenticated users
-        auth_url = None
-        if not authenticated:
-            try:
-                # Use the OAuth endpoint from our API
-                auth_url = "/oauth/get_authorization_url"
-            except Exception:
-                auth_url = "/oauth/get_authorization_url"  # Fallback to API endpoint
-        return templates.TemplateResponse("client_portal.html", {
-            "request": request,
-            "authenticated": authenticated,
-            "auth_url": auth_url,
-            "access_token": access_token,
-            "user_info": user_info,
-            "token_expires": token_expires,
-            "base_url": get_base_url(request)
-        })
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error loading client portal: {str(e)}")
+    authenticated = user is not None
+    access_token = None
+    user_info = {}
+    token_expires = None
+
+    if authenticated:
+        access_token = user.get("access_token")
+        user_info = {
+            "email": user.get("email"),
+            "name": user.get("display_name")
+        }
+        # Format token expiration
+        if user.get("token_expires_at"):
+            expires_at = datetime.fromtimestamp(user["token_expires_at"], UTC)
+            token_expires = expires_at.strftime("%Y-%m-%d %H:%M:%S")
+    # Get authorization URL for non-authenticated users
+    auth_url = None
+    if not authenticated:
+        try:
+            # Use the OAuth endpoint from our API
+            auth_url = "/oauth/get_authorization_url"
+        except Exception:
+            auth_url = "/oauth/get_authorization_url"  # Fallback to API endpoint
+    return templates.TemplateResponse("client_portal.html", {
+        "request": request,
+        "authenticated": authenticated,
+        "auth_url": auth_url,
+        "access_token": access_token,
+        "user_info": user_info,
+        "token_expires": token_expires,
+        "base_url": get_base_url(request)
+    })
 
 
 @client_router.get("/get-auth-url", summary="Get OAuth Authorization URL")
-async def get_auth_url(request: Request):
+async def get_auth_url(request: Request) -> dict:
     """
     Get the OAuth authorization URL dynamically.
     """
     try:
         # Check if Azure credentials are properly configured
-        from config import SYSTEM_CREDENTIALS
         if not SYSTEM_CREDENTIALS.get("client_id") or SYSTEM_CREDENTIALS.get("client_id") == "your-client-id-here":
             return {
                 "success": False,
@@ -107,34 +107,33 @@ async def client_oauth_callback_page(request: Request):
 
 
 @client_router.get("/callback-handler", summary="OAuth Callback Handler (API)")
-async def client_oauth_callback_handler(request: Request, code: str, state: str = None):
+@graph_endpoint("OAuth callback error", status_code=400)
+async def client_oauth_callback_handler(
+    request: Request, code: str, state: str = None, auth_service: AuthService = Depends(get_auth_service)
+):
     """
     Handle OAuth callback and store user session (API endpoint).
     This is called by the JavaScript on the callback page.
     """
-    try:
-        # Exchange code for tokens and save to database
-        result = await auth_service.exchange_code_for_tokens(code, state)
-        # Create response with session token cookie
-        response = RedirectResponse(url="/client", status_code=302)
-        response.set_cookie(
-            "session_token",
-            result["session_token"],
-            max_age=24*3600,  # 24 hours
-            httponly=True,
-            secure=False  # Set to True in production with HTTPS
-        )
-        return response
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"OAuth callback error: {str(e)}")
+    # Exchange code for tokens and save to database
+    result = await auth_service.exchange_code_for_tokens(code, state)
+    # Create response with session token cookie
+    response = RedirectResponse(url="/client", status_code=302)
+    response.set_cookie(
+        "session_token",
+        result["session_token"],
+        max_age=24*3600,  # 24 hours
+        httponly=True,
+        secure=False  # Set to True in production with HTTPS
+    )
+    return response
 
 
 @client_router.get("/test-api", response_class=HTMLResponse, summary="API Testing Console")
-async def test_api_page(request: Request):
+async def test_api_page(request: Request, user: dict | None = Depends(get_current_user)):
     """
     API testing console page.
     """
-    user = get_current_user(request)
     if not user:
         # Redirect to login if not authenticated
         return RedirectResponse(url="/client", status_code=302)
@@ -150,27 +149,23 @@ async def test_api_page(request: Request):
 
 
 @client_router.post("/test-endpoint", summary="Test API Endpoint")
-async def test_endpoint(request: Request, endpoint: str = Form(...), method: str = Form(...)):
+async def test_endpoint(
+    request: Request,
+    endpoint: str = Form(...),
+    method: str = Form(...),
+    user: dict | None = Depends(get_current_user),
+) -> dict:
     """
     Test an API endpoint and return results.
     """
-    user = get_current_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Authentication required")
     try:
         base_url = get_base_url(request)
         headers = {"Authorization": f"Bearer {user['access_token']}"}
-        async with httpx.AsyncClient() as client:
-            if method.upper() == "GET":
-                response = await client.get(f"{base_url}{endpoint}", headers=headers)
-            elif method.upper() == "POST":
-                response = await client.post(f"{base_url}{endpoint}", headers=headers)
-            elif method.upper() == "PATCH":
-                response = await client.patch(f"{base_url}{endpoint}", headers=headers)
-            elif method.upper() == "DELETE":
-                response = await client.delete(f"{base_url}{endpoint}", headers=headers)
-            else:
-                raise HTTPException(status_code=400, detail="Unsupported HTTP method")
+        if method.upper() not in ("GET", "POST", "PATCH", "DELETE"):
+            raise HTTPException(status_code=400, detail="Unsupported HTTP method")
+        response = await api_test_client.request(method.upper(), f"{base_url}{endpoint}", headers=headers)
         return {
             "success": response.status_code < 400,
             "status_code": response.status_code,
@@ -186,47 +181,52 @@ async def test_endpoint(request: Request, endpoint: str = Form(...), method: str
         }
 
 
+async def _invalidate_session(session_token: str) -> None:
+    """Deactivate a session in the DB, then drop any copy a request re-cached before the write landed."""
+    await credentials_db.invalidate_session_async(session_token)
+    invalidate_cached_session(session_token)
+
+
 @client_router.get("/logout", summary="Logout User")
-async def logout(request: Request):
+async def logout(request: Request, background_tasks: BackgroundTasks):
     """
     Clear user session and redirect to login.
     """
     session_token = request.cookies.get("session_token")
     if session_token:
-        credentials_db.invalidate_session(session_token)
+        # Drop the cached session now; the DB write can finish after the redirect is sent
+        invalidate_cached_session(session_token)
+        background_tasks.add_task(_invalidate_session, session_token)
     response = RedirectResponse(url="/client", status_code=302)
     response.delete_cookie("session_token")
     return response
 
 
 @client_router.get("/status", summary="Get Authentication Status")
-async def get_status(request: Request):
+async def get_status(user: dict | None = Depends(get_current_user)) -> dict:
     """
     Get current authentication status (API endpoint).
     """
-    user = get_current_user(request)
     if not user:
         return {"authenticated": False, "message": "No active session"}
     # Check token expiration
-    token_expires_at = datetime.fromisoformat(user["token_expires_at"])
-    token_valid = token_expires_at > datetime.utcnow()
+    token_valid = user["token_expires_at"] > time.time()
     return {
         "authenticated": token_valid,
         "user_info": {
             "email": user["email"],
             "name": user["display_name"]
         },
-        "token_expires_at": user["token_expires_at"],
+        "token_expires_at": datetime.fromtimestamp(user["token_expires_at"], UTC).isoformat(),
         "token_valid": token_valid
     }
 
 
 @client_router.get("/simple-test", summary="Simple OAuth Test")
-async def simple_oauth_test(request: Request):
+async def simple_oauth_test(user: dict | None = Depends(get_current_user)) -> dict:
     """
     Simple endpoint to test OAuth functionality.
     """
-    user = get_current_user(request)
     if not user:
         return {"authenticated": False, "message": "Please authenticate first"}
     return {
@@ -4,15 +4,18 @@ Provides endpoints for reading, sending, and managing emails through Microsoft G
 """
 
 import logging
-from datetime import datetime
 
 from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
 from auth.dependencies import require_oauth_token
-from schemas.common_schemas import BaseResponse
+from schemas.common_schemas import BaseResponse, utc_timestamp
 from schemas.email_schemas import (
     AttachmentRequest,
     AttachmentResponse,
+    BatchEmailRequest,
+    BatchEmailResponse,
     CreateDraftRequest,
     CreateDraftResponse,
     EmailResponse,
@@ -24,9 +27,8 @@ from schemas.email_schemas import (
     UpdateEmailResponse,
 )
 from services.email_service import EmailService
+from utils.handlers import graph_endpoint
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize router and service
@@ -34,20 +36,29 @@ email_router = APIRouter(prefix="/emails", tags=["Email Operations"])
 email_service = EmailService()
 
 
+BEARER_PREFIX = "Bearer "
+
+
 # Dependency to extract and validate access token
 async def get_access_token(authorization: str = Header(..., alias="Authorization")):
     """Extract and validate access token from Authorization header."""
-    if not authorization.startswith("Bearer "):
+    if not authorization.startswith(BEARER_PREFIX):
         raise HTTPException(status_code=401, detail="Invalid authorization header format. Use 'Bearer <token>'")
 
-    token = authorization.replace("Bearer ", "")
+    token = authorization[len(BEARER_PREFIX) :].strip()
     if not token:
         raise HTTPException(status_code=401, detail="Access token is required")
 
     return token
 
 
+async def get_graph_headers(access_token: str = Depends(get_access_token)) -> dict[str, str]:
+    """Build the Graph request headers once per request for routes that call Graph directly."""
+    return {"Authorization": f"Bearer {access_token}"}
+
+
 @email_router.get("/list", summary="List Emails")
+@graph_endpoint("Failed to list emails")
 async def list_emails(
     request: Request,
     limit: int = Query(10, ge=1, le=100, description="Number of emails to retrieve (1-100)"),
@@ -60,148 +71,131 @@ async def list_emails(
     """
     List emails from Outlook using Microsoft Graph API.
     """
-    try:
-        result = await email_service.list_emails(
-            access_token=access_token,
-            limit=limit,
-            offset=offset,
-            folder=folder,
-            search=search,
-            include_body=include_body,
-        )
-
-        return ListEmailsResponse(message="Emails retrieved successfully", emails=result)
+    result = await email_service.list_emails(
+        access_token=access_token,
+        limit=limit,
+        offset=offset,
+        folder=folder,
+        search=search,
+        include_body=include_body,
+    )
 
-    except Exception as e:
-        logger.error(f"Error listing emails: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to list emails: {str(e)}")
+    # The service already returns Graph-shaped data, so skip re-validating every email
+    return ListEmailsResponse.model_construct(message="Emails retrieved successfully", emails=result)
 
 
 @email_router.get("/{message_id}", summary="Get Email by ID")
-async def get_email_by_id(message_id: str, access_token: str = Depends(get_access_token)) -> EmailResponse:
+@graph_endpoint("Failed to get email")
+async def get_email_by_id(
+    message_id: str,
+    stream: bool = Query(False, description="Relay Graph's JSON as it arrives instead of buffering it"),
+    access_token: str = Depends(get_access_token),
+    graph_headers: dict[str, str] = Depends(get_graph_headers),
+) -> EmailResponse:
     """
     Get a specific email by its ID.
     """
-    try:
-        result = await email_service.get_email_by_id(access_token, message_id)
+    if stream:
+        graph_response = await email_service.stream_email(graph_headers, message_id)
+        return StreamingResponse(
+            graph_response.aiter_bytes(),
+            media_type="application/json",
+            background=BackgroundTask(graph_response.aclose),
+        )
 
-        return EmailResponse(message="Email retrieved successfully", email=result)
+    result = await email_service.get_email_by_id(access_token, message_id)
 
-    except Exception as e:
-        logger.error(f"Error getting email {message_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to get email: {str(e)}")
+    return EmailResponse.model_construct(message="Email retrieved successfully", email=result)
 
 
 @email_router.post("/send", summary="Send Email")
+@graph_endpoint("Failed to send email")
 async def send_email(request: SendEmailRequest, access_token: str = Depends(get_access_token)) -> SendEmailResponse:
     """
     Send an email through Outlook using Microsoft Graph API.
     """
-    try:
-        result = await email_service.send_email(access_token, request)
-
-        return SendEmailResponse(
-            message="Email sent successfully", sent_at=result["sent_at"], recipients=result["recipients"]
-        )
+    result = await email_service.send_email(access_token, request)
 
-    except Exception as e:
-        logger.error(f"Error sending email: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+    return SendEmailResponse(
+        message="Email sent successfully", sent_at=result["sent_at"], recipients=result["recipients"]
+    )
 
 
 @email_router.post("/drafts", summary="Create Draft Email")
+@graph_endpoint("Failed to create draft")
 async def create_draft_email(
     request: CreateDraftRequest, access_token: str = Depends(get_access_token)
 ) -> CreateDraftResponse:
     """
     Create a draft email in Outlook.
     """
-    try:
-        result = await email_service.create_draft(access_token, request)
+    result = await email_service.create_draft(access_token, request)
 
-        return CreateDraftResponse(
-            message="Draft created successfully", draft_id=result["result"], created_at=result["created_at"]
-        )
-
-    except Exception as e:
-        logger.error(f"Error creating draft: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to create draft: {str(e)}")
+    return CreateDraftResponse(
+        message="Draft created successfully", draft_id=result["result"], created_at=result["created_at"]
+    )
 
 
 @email_router.patch("/{email_id}", summary="Update Email")
+@graph_endpoint("Failed to update email")
 async def update_email(
     email_id: str, request: UpdateEmailRequest, access_token: str = Depends(get_access_token)
 ) -> UpdateEmailResponse:
     """
     Update an existing email's subject and/or body.
     """
-    try:
-        result = await email_service.update_email(access_token, email_id, request)
-
-        return UpdateEmailResponse(
-            message=result["result"],
-            updated_at=result["updated_at"],
-        )
+    result = await email_service.update_email(access_token, email_id, request)
 
-    except Exception as e:
-        logger.error(f"Error updating email {email_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to update email: {str(e)}")
+    return UpdateEmailResponse(
+        message=result["result"],
+        updated_at=result["updated_at"],
+    )
 
 
 @email_router.post("/drafts/{draft_id}/attachments", summary="Add Attachment to Draft")
+@graph_endpoint("Failed to add attachment")
 async def add_attachment_to_draft(
     draft_id: str, request: AttachmentRequest, access_token: str = Depends(get_access_token)
 ) -> AttachmentResponse:
     """
     Add attachments to an existing draft email.
     """
-    try:
-        result = await email_service.add_attachment_to_draft(access_token, draft_id, request)
+    result = await email_service.add_attachment_to_draft(access_token, draft_id, request)
 
-        return AttachmentResponse(
-            message="Attachment added successfully",
-            attachment_name=result["attachment_name"],
-            operation=result["operation"],
-        )
-
-    except Exception as e:
-        logger.error(f"Error adding attachment to draft {draft_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to add attachment: {str(e)}")
+    return AttachmentResponse(
+        message="Attachment added successfully",
+        attachment_id=result["attachment_id"],
+        attachment_name=result["attachment_name"],
+        operation=result["operation"],
+    )
 
 
 @email_router.post("/drafts/{draft_id}/send", summary="Send Draft Email")
+@graph_endpoint("Failed to send draft")
 async def send_draft_email(draft_id: str, access_token: str = Depends(get_access_token)) -> BaseResponse:
     """
     Send a draft email through Outlook.
     """
-    try:
-        await email_service.send_draft(access_token, draft_id)
+    await email_service.send_draft(access_token, draft_id)
 
-        return BaseResponse(message="Draft sent successfully")
-
-    except Exception as e:
-        logger.error(f"Error sending draft {draft_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to send draft: {str(e)}")
+    return BaseResponse(message="Draft sent successfully")
 
 
 @email_router.patch("/{email_id}/priority", summary="Set Email Priority")
+@graph_endpoint("Failed to prioritize email")
 async def prioritize_email(
     email_id: str, request: PrioritizeEmailRequest, access_token: str = Depends(get_access_token)
 ) -> BaseResponse:
     """
     Set the priority/importance level of an email.
     """
-    try:
-        await email_service.prioritize_email(access_token, email_id, request.priority_level)
-
-        return BaseResponse(message=f"Email priority set to {request.priority_level.value}")
+    await email_service.prioritize_email(access_token, email_id, request.priority_level)
 
-    except Exception as e:
-        logger.error(f"Error prioritizing email {email_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to prioritize email: {str(e)}")
+    return BaseResponse(message=f"Email priority set to {request.priority_level.value}")
 
 
 @email_router.patch("/{email_id}/read", summary="Mark Email as Read/Unread")
+@graph_endpoint("Failed to update email read status")
 async def mark_email_read(
     email_id: str,
     is_read: bool = Query(True, description="Mark as read (true) or unread (false)"),
@@ -210,52 +204,53 @@ async def mark_email_read(
     """
     Mark an email as read or unread.
     """
-    try:
-        await email_service.mark_email_read(access_token, email_id, is_read)
+    await email_service.mark_email_read(access_token, email_id, is_read)
 
-        status = "read" if is_read else "unread"
-        return BaseResponse(message=f"Email marked as {status}")
-
-    except Exception as e:
-        logger.error(f"Error marking email {email_id} as read: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to update email read status: {str(e)}")
+    status = "read" if is_read else "unread"
+    return BaseResponse(message=f"Email marked as {status}")
 
 
 @email_router.delete("/{email_id}", summary="Delete Email")
+@graph_endpoint("Failed to delete email")
 async def delete_email(email_id: str, access_token: str = Depends(get_access_token)) -> BaseResponse:
     """
     Delete an email (move to Deleted Items folder).
     """
-    try:
-        result = await email_service.delete_email(access_token, email_id)
+    result = await email_service.delete_email(access_token, email_id)
 
-        return BaseResponse(
-            message=result["result"],
-            timestamp=result["deleted_at"],
-        )
+    return BaseResponse(
+        message=result["result"],
+        timestamp=result["deleted_at"],
+    )
 
-    except Exception as e:
-        logger.error(f"Error deleting email {email_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to delete email: {str(e)}")
+
+@email_router.post("/batch", summary="Batch Email Operations")
+@graph_endpoint("Failed to run batch operations")
+async def batch_emails(
+    request: BatchEmailRequest, graph_headers: dict[str, str] = Depends(get_graph_headers)
+) -> BatchEmailResponse:
+    """
+    Mark read/unread, prioritize or delete several emails in as few Graph round-trips as possible.
+    """
+    results = await email_service.batch_emails(graph_headers, request.requests)
+
+    return BatchEmailResponse(message=f"Processed {len(results)} operations", results=results)
 
 
 @email_router.get("/folders/list", summary="List Mail Folders")
+@graph_endpoint("Failed to list folders")
 async def list_folders(access_token: str = Depends(get_access_token)) -> BaseResponse:
     """
     Get list of all mail folders.
     """
-    try:
-        result = await email_service.list_folders(access_token)
+    result = await email_service.list_folders(access_token)
 
-        return BaseResponse(message="Folders retrieved successfully", **result)
-
-    except Exception as e:
-        logger.error(f"Error listing folders: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to list folders: {str(e)}")
+    return BaseResponse(message="Folders retrieved successfully", **result)
 
 
 # Legacy endpoints for backward compatibility (deprecated)
 @email_router.get("/list-message", summary="Read Emails (Legacy)", deprecated=True)
+@graph_endpoint("Failed to list emails")
 async def list_emails_legacy(
     limit: int = Query(10, ge=1, le=100, description="Number of emails to retrieve (1-100)"),
     offset: int = Query(0, ge=0, description="Number of emails to skip"),
@@ -265,37 +260,29 @@ async def list_emails_legacy(
     access_token: str = Header(..., description="OAuth access token for Microsoft Graph API"),
 ) -> dict:
     """Legacy endpoint for listing emails. Use /emails/list instead."""
-    try:
-        result = await email_service.list_emails(access_token, limit, offset, folder, search, include_body)
-
-        return {
-            "status": "success",
-            "timestamp": datetime.utcnow().isoformat() + "Z",
-            "emails": result.get("emails", []),
-        }
+    result = await email_service.list_emails(access_token, limit, offset, folder, search, include_body)
 
-    except Exception as e:
-        logger.error(f"Error listing emails (legacy): {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to list emails: {str(e)}")
+    return {
+        "status": "success",
+        "timestamp": utc_timestamp(),
+        "emails": result.get("emails", []),
+    }
 
 
 @email_router.get("/get-message", summary="Get Email by ID (Legacy)", deprecated=True)
+@graph_endpoint("Failed to get email")
 async def get_email_by_id_legacy(
     message_id: str = Query(..., description="ID of the email to retrieve"),
     access_token: str = Header(..., description="OAuth access token for Microsoft Graph API"),
 ) -> dict:
     """Legacy endpoint for getting email by ID. Use /emails/{message_id} instead."""
-    try:
-        result = await email_service.get_email_by_id(access_token, message_id)
-
-        return {"status": "success", "timestamp": datetime.utcnow().isoformat() + "Z", "email": result}
+    result = await email_service.get_email_by_id(access_token, message_id)
 
-    except Exception as e:
-        logger.error(f"Error getting email (legacy): {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to get email: {str(e)}")
+    return {"status": "success", "timestamp": utc_timestamp(), "email": result}
 
 
 @email_router.post("/send-message", summary="Send Email (Legacy)", deprecated=True)
+@graph_endpoint("Failed to send email")
 async def send_email_legacy(
     to: str = Query(..., description="Comma-separated list of recipient email addresses"),
     subject: str = Query(..., description="Subject of the email"),
@@ -303,13 +290,9 @@ async def send_email_legacy(
     access_token: str = Header(..., description="OAuth access token for Microsoft Graph API"),
 ) -> dict:
     """Legacy endpoint for sending email. Use /emails/send instead."""
-    try:
-        request = SendEmailRequest(to=to.split(","), subject=subject, body=message)
+    request = SendEmailRequest(to=to.split(","), subject=subject, body=message)
 
-        result = await email_service.send_email(access_token, request)
+    result = await email_service.send_email(access_token, request)
 
-        return {"status": "success", "timestamp": datetime.utcnow().isoformat() + "Z", "result": result}
+    return {"status": "success", "timestamp": utc_timestamp(), "result": result}
 
-    except Exception as e:
-        logger.error(f"Error sending email (legacy): {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
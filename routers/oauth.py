@@ -3,53 +3,52 @@ OAuth authentication router for Outlook service.
 Handles OAuth flow for Microsoft Graph API access.
 """
 
+import asyncio
+import functools
 import logging
 
-import httpx
+from dify_plugin.entities.oauth import ToolOAuthCredentials
 from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import JSONResponse
 
 from config import REDIRECT_URI
 from models.database import credentials_db
-from providers.outlook import OutlookProvider
+from providers.outlook import GRAPH_ME_URL, graph_async_client, outlook_provider
+from utils.hashing import token_key
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize router
 oauth_router = APIRouter(prefix="/oauth", tags=["OAuth Authentication"])
 
-# Initialize Outlook provider
-outlook_provider = OutlookProvider()
+
+@functools.lru_cache(maxsize=1)
+def _authorization_response() -> dict:
+    """Build the authorization URL response once; failures aren't cached, so they're retried next call."""
+    auth_url = outlook_provider._oauth_get_authorization_url(redirect_uri=REDIRECT_URI)
+    logger.info("Generated OAuth authorization URL")
+    return {
+        "authorization_url": auth_url,
+        "redirect_uri": REDIRECT_URI,
+        "message": "Visit the authorization_url to grant permissions, then you'll be redirected back to the callback endpoint.",
+    }
 
 
 @oauth_router.get("/get_authorization_url", summary="Initiate OAuth Authorization")
-async def get_authorization_url():
+async def get_authorization_url() -> dict:
     """
     Generate and return the Microsoft OAuth authorization URL.
     Users should visit this URL to grant permissions.
     """
     try:
-        auth_url = outlook_provider._oauth_get_authorization_url(
-            redirect_uri=REDIRECT_URI
-        )
-
-        logger.info("Generated OAuth authorization URL")
-
-        return {
-            "authorization_url": auth_url,
-            "redirect_uri": REDIRECT_URI,
-            "message": "Visit the authorization_url to grant permissions, then you'll be redirected back to the callback endpoint.",
-        }
-
+        return _authorization_response()
     except Exception as e:
-        logger.error(f"Failed to generate authorization URL: {e}")
+        logger.error("Failed to generate authorization URL: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to generate authorization URL: {str(e)}")
 
 
 @oauth_router.get("/get_credentials", summary="Get OAuth Credentials")
-async def get_credentials(code: str = Query(..., description="Authorization code from the redirect")):
+async def get_credentials(code: str = Query(..., description="Authorization code from the redirect")) -> dict:
     """
     Exchange the authorization code for OAuth credentials and save to database.
 
@@ -60,8 +59,9 @@ async def get_credentials(code: str = Query(..., description="Authorization code
             raise HTTPException(status_code=400, detail="Authorization code is required")
 
         # Exchange code for credentials
-        credentials = outlook_provider._oauth_get_credentials(
-            redirect_uri=REDIRECT_URI, code=code
+        # MSAL's token call is blocking, so it runs on a worker thread instead of the event loop
+        credentials = await asyncio.to_thread(
+            outlook_provider._oauth_get_credentials, redirect_uri=REDIRECT_URI, code=code
         )
 
         tokens = {
@@ -69,16 +69,18 @@ async def get_credentials(code: str = Query(..., description="Authorization code
             "refresh_token": credentials.credentials.get("refresh_token"),
             "expires_in": credentials.credentials.get("expires_in", 3600),
             "token_type": "Bearer",
+            "token_cache": credentials.credentials.get("token_cache"),
         }
 
         # Get user information from Microsoft Graph API
         user_info = await get_user_info(tokens["access_token"])
-        # Save credentials to database
-        user_id = credentials_db.save_user_credentials(user_info, tokens)
-        # Create a session token for web interface integration
-        session_token = credentials_db.create_session(user_id)
+        # Save credentials and create a session token for web interface integration in one transaction
+        user_id, session_token = await credentials_db.save_credentials_and_session_async(user_info, tokens)
 
-        logger.info(f"Successfully exchanged authorization code for credentials and saved for user: {user_info.get('mail', 'unknown')}")
+        logger.info(
+            "Successfully exchanged authorization code for credentials and saved for user: %s",
+            user_info.get("mail", "unknown"),
+        )
 
         return {
             "message": "Credentials obtained and saved successfully",
@@ -94,28 +96,49 @@ async def get_credentials(code: str = Query(..., description="Authorization code
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to get credentials: {e}")
+        logger.error("Failed to get credentials: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to get credentials: {str(e)}")
 
 
 async def get_user_info(access_token: str) -> dict:
     """Get user information from Microsoft Graph API."""
     try:
-        async with httpx.AsyncClient() as client:
-            headers = {"Authorization": f"Bearer {access_token}"}
-            response = await client.get("https://graph.microsoft.com/v1.0/me", headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.error(f"Failed to get user info: {response.status_code} {response.text}")
-                return {"mail": "unknown@example.com", "displayName": "Unknown User"}
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = await graph_async_client.get(GRAPH_ME_URL, headers=headers)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            logger.error("Failed to get user info: %s %s", response.status_code, response.text)
+            return {"mail": "unknown@example.com", "displayName": "Unknown User"}
     except Exception as e:
-        logger.error(f"Error getting user info: {e}")
+        logger.error("Error getting user info: %s", e)
         return {"mail": "unknown@example.com", "displayName": "Unknown User"}
 
 
+# In-flight refreshes keyed by the refresh token's token_key digest, so concurrent callers share one upstream call
+_refresh_inflight: dict[bytes, asyncio.Task] = {}
+
+
+async def _refresh_credentials(refresh_token: str) -> ToolOAuthCredentials:
+    """Refresh credentials through the shared provider on a worker thread, keeping MSAL off the event loop."""
+    return await asyncio.to_thread(
+        outlook_provider.oauth_refresh_credentials, credentials={"refresh_token": refresh_token}
+    )
+
+
+def _refresh_once(refresh_token: str) -> asyncio.Task:
+    """Return the in-flight refresh task for a refresh token, starting one if none is running."""
+    key = token_key(refresh_token)
+    task = _refresh_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_refresh_credentials(refresh_token))
+        _refresh_inflight[key] = task
+        task.add_done_callback(lambda _: _refresh_inflight.pop(key, None))
+    return task
+
+
 @oauth_router.post("/refresh", summary="Refresh Access Token")
-async def refresh_token(refresh_token: str):
+async def refresh_token(refresh_token: str) -> dict:
     """
     Refresh an expired access token using the refresh token.
 
@@ -128,13 +151,8 @@ async def refresh_token(refresh_token: str):
         if not refresh_token:
             raise HTTPException(status_code=400, detail="Refresh token is required")
 
-        # Create credentials object for refresh
-        credentials = {"refresh_token": refresh_token}
-
-        # Refresh the credentials
-        new_credentials = outlook_provider.oauth_refresh_credentials(
-            redirect_uri=REDIRECT_URI, credentials=credentials
-        )
+        # Served from the provider's refreshed-credentials cache until shortly before expiry
+        new_credentials = await asyncio.shield(_refresh_once(refresh_token))
 
         logger.info("Successfully refreshed access token")
 
@@ -149,12 +167,12 @@ async def refresh_token(refresh_token: str):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Token refresh failed: {e}")
+        logger.error("Token refresh failed: %s", e)
         raise HTTPException(status_code=500, detail=f"Token refresh failed: {str(e)}")
 
 
 @oauth_router.post("/validate", summary="Validate Access Token")
-async def validate_token(access_token: str):
+async def validate_token(access_token: str) -> dict:
     """
     Validate an access token by making a test call to Microsoft Graph API.
 
@@ -169,7 +187,7 @@ async def validate_token(access_token: str):
 
         # Validate the credentials
         credentials = {"access_token": access_token}
-        outlook_provider._validate_credentials(credentials)
+        await outlook_provider._validate_credentials_async(credentials)
 
         logger.info("Access token validation successful")
 
@@ -178,7 +196,7 @@ async def validate_token(access_token: str):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Token validation failed: {e}")
+        logger.error("Token validation failed: %s", e)
         return JSONResponse(
             status_code=401, content={"message": "Access token is invalid or expired", "valid": False, "error": str(e)}
         )
@@ -10,7 +10,10 @@ from .common_schemas import (
 from .email_schemas import (
     AttachmentRequest,
     CreateDraftRequest,
+    EmailAttachment,
+    EmailBody,
     EmailListResponse,
+    EmailRecipient,
     EmailResponse,
     SendEmailRequest,
     UpdateEmailRequest,
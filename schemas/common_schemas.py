@@ -2,11 +2,31 @@
 Common schemas used across the Outlook service API.
 """
 
-from datetime import datetime
+import time
+from datetime import UTC, datetime
 from enum import Enum
 from typing import Any
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
+
+_ts_second = 0
+_ts_value = ""
+
+
+def utc_timestamp() -> str:
+    """Return the current UTC time as an ISO-8601 "Z" string, reformatted at most once per second."""
+    global _ts_second, _ts_value
+    second = int(time.time())
+    if second != _ts_second:
+        _ts_value = datetime.fromtimestamp(second, UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+        _ts_second = second
+    return _ts_value
+
+
+class ReadOnlyModel(BaseModel):
+    """Base for response-only models that are built once and never mutated."""
+
+    model_config = ConfigDict(frozen=True)
 
 
 class StatusEnum(str, Enum):
@@ -21,7 +41,7 @@ class BaseResponse(BaseModel):
     """Base response model for all API responses."""
 
     status: StatusEnum = StatusEnum.SUCCESS
-    timestamp: str = Field(default_factory=lambda: datetime.utcnow().isoformat() + "Z")
+    timestamp: str = Field(default_factory=utc_timestamp)
     message: Any | None = None
 
 
@@ -40,7 +60,7 @@ class PaginationRequest(BaseModel):
     offset: int = Field(default=0, ge=0, description="Number of items to skip")
 
 
-class PaginationResponse(BaseModel):
+class PaginationResponse(ReadOnlyModel):
     """Response model for paginated results."""
 
     total_count: int = Field(description="Total number of items")
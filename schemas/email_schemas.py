@@ -2,12 +2,33 @@
 Email-related schemas for the Outlook service API.
 """
 
-from enum import Enum
+import re
+from enum import Enum, StrEnum
 from typing import Any
 
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator, validate_email
 
-from .common_schemas import BaseResponse, PaginationResponse
+from .common_schemas import BaseResponse, PaginationResponse, ReadOnlyModel
+
+# Plain ASCII addresses; anything else (IDN, quoted local parts) goes through email-validator
+_SIMPLE_EMAIL = re.compile(r"[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}")
+
+# Standard base64 alphabet; checked without decoding so large attachments aren't copied
+_BASE64 = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
+
+def _normalize_recipients(value: str | list[str] | None) -> str | None:
+    """Validate a comma-separated (or list of) addresses and return them comma-joined."""
+    if value is None:
+        return None
+    addresses = []
+    for entry in value.split(",") if isinstance(value, str) else value:
+        address = entry.strip()
+        if not address:
+            continue
+        # validate_email returns (name, address); keep only the bare address for Graph
+        addresses.append(address if _SIMPLE_EMAIL.fullmatch(address) else validate_email(address)[1])
+    return ",".join(addresses) or None
 
 
 class ImportanceLevel(str, Enum):
@@ -25,21 +46,21 @@ class BodyType(str, Enum):
     HTML = "html"
 
 
-class EmailRecipient(BaseModel):
+class EmailRecipient(ReadOnlyModel):
     """Email recipient model."""
 
     name: str | None = None
     email: EmailStr
 
 
-class EmailBody(BaseModel):
+class EmailBody(ReadOnlyModel):
     """Email body content model."""
 
     content: str
     content_type: BodyType = BodyType.TEXT
 
 
-class EmailAttachment(BaseModel):
+class EmailAttachment(ReadOnlyModel):
     """Email attachment model."""
 
     name: str
@@ -57,6 +78,8 @@ class ListEmailsResponse(BaseResponse):
 class SendEmailRequest(BaseModel):
     """Request model for sending emails."""
 
+    model_config = ConfigDict(frozen=True)
+
     to: str = Field(..., description="Comma-separated list of recipient email addresses")
     cc: str | None | None = Field(None, description="Comma-separated list of CC recipient email addresses")
     bcc: str | None | None = Field(None, description="Comma-separated list of BCC recipient email addresses")
@@ -65,6 +88,11 @@ class SendEmailRequest(BaseModel):
     body_type: BodyType = Field(BodyType.TEXT, description="Content type of the body")
     importance: ImportanceLevel = Field(ImportanceLevel.NORMAL, description="Importance level of the email")
 
+    @field_validator("to", "cc", "bcc", mode="before")
+    @classmethod
+    def _validate_recipients(cls, value: str | list[str] | None) -> str | None:
+        return _normalize_recipients(value)
+
 
 class GetEmailResponse(BaseResponse):
     """Response model for getting a single email."""
@@ -94,6 +122,15 @@ class AttachmentRequest(BaseModel):
     file_content: str = Field(..., description="Base64 encoded file content")
     content_type: str | None = Field(None, description="MIME type of the file")
 
+    @field_validator("file_content")
+    @classmethod
+    def _validate_base64(cls, value: str) -> str:
+        # MIME encoders wrap base64 at 76 columns; Graph expects it unwrapped
+        value = "".join(value.split())
+        if len(value) % 4 or not _BASE64.fullmatch(value):
+            raise ValueError("file_content must be base64 encoded")
+        return value
+
 
 class PrioritizeEmailRequest(BaseModel):
     """Request model for prioritizing emails."""
@@ -101,8 +138,31 @@ class PrioritizeEmailRequest(BaseModel):
     priority_level: ImportanceLevel = Field(ImportanceLevel.NORMAL, description="Priority level")
 
 
+class BatchOperation(StrEnum):
+    """Operations that can be combined into a single batch request."""
+
+    MARK_READ = "mark_read"
+    PRIORITIZE = "prioritize"
+    DELETE = "delete"
+
+
+class BatchEmailOperation(BaseModel):
+    """A single operation within a batch request."""
+
+    operation: BatchOperation = Field(..., description="Operation to apply to the email")
+    email_id: str = Field(..., description="ID of the email to operate on")
+    is_read: bool = Field(True, description="Read state for mark_read operations")
+    priority_level: ImportanceLevel = Field(ImportanceLevel.NORMAL, description="Priority for prioritize operations")
+
+
+class BatchEmailRequest(BaseModel):
+    """Request model for batched email operations."""
+
+    requests: list[BatchEmailOperation] = Field(..., min_length=1, description="Operations to perform")
+
+
 # Response Models
-class EmailDetail(BaseModel):
+class EmailDetail(ReadOnlyModel):
     """Detailed email model."""
 
     id: str
@@ -125,6 +185,8 @@ class EmailDetail(BaseModel):
 class EmailListResponse(BaseResponse):
     """Response model for email list."""
 
+    model_config = ConfigDict(frozen=True)
+
     emails: list[EmailDetail]
     pagination: PaginationResponse
     folder: str
@@ -165,7 +227,13 @@ class AttachmentResponse(BaseResponse):
     operation: str  # 'added', 'removed', 'updated'
 
 
-class FolderInfo(BaseModel):
+class BatchEmailResponse(BaseResponse):
+    """Response model for batched email operations."""
+
+    results: list[dict[str, Any]] = Field(..., description="Per-operation results, in request order")
+
+
+class FolderInfo(ReadOnlyModel):
     """Mail folder information model."""
 
     id: str
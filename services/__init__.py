@@ -6,4 +6,4 @@ Contains business logic and external service integrations.
 from .auth_service import AuthService
 from .email_service import EmailService
 
-__all__ = ["EmailService", "AuthService"]
+__all__ = ["AuthService", "EmailService"]
@@ -2,21 +2,33 @@
 Authentication service for handling OAuth operations and credential storage.
 """
 
+import asyncio
 import logging
+import threading
 from typing import Any
 
-import httpx
+from cachetools import TLRUCache
 
 from config import REDIRECT_URI
 from models.database import credentials_db
-from providers.outlook import OutlookProvider
+from providers.outlook import GRAPH_ME_URL, OutlookProvider, graph_async_client
+from utils.hashing import token_key
+from utils.tokens import token_exp, validated_ttu
 
 logger = logging.getLogger(__name__)
 
 
+# /me profiles as (exp claim, profile), keyed by the access token's token_key digest and kept as long as a
+# validation of the same token would be; only successful lookups are cached
+_user_info_cache: TLRUCache = TLRUCache(maxsize=10_000, ttu=validated_ttu)
+_user_info_cache_lock = threading.Lock()
+
+
 class AuthService:
     """Service class for authentication operations."""
 
+    __slots__ = ("outlook_provider",)
+
     def __init__(self):
         self.outlook_provider = OutlookProvider()
 
@@ -31,29 +43,29 @@ class AuthService:
             return {"authorization_url": auth_url, "redirect_uri": REDIRECT_URI}
 
         except Exception as e:
-            logger.error(f"Failed to generate authorization URL: {e}")
+            logger.error("Failed to generate authorization URL: %s", e)
             raise
 
     async def exchange_code_for_tokens(self, code: str, state: str = None) -> dict[str, Any]:
         """Exchange authorization code for access tokens and save to database."""
         try:
             # Exchange code for tokens using the OAuth provider
-            oauth_credentials = self.outlook_provider._oauth_get_credentials(
-                redirect_uri=REDIRECT_URI, code=code
+            # MSAL's token calls are blocking, so they run on a worker thread instead of the event loop
+            oauth_credentials = await asyncio.to_thread(
+                self.outlook_provider._oauth_get_credentials, redirect_uri=REDIRECT_URI, code=code
             )
             tokens = {
                 "access_token": oauth_credentials.credentials.get("access_token"),
                 "refresh_token": oauth_credentials.credentials.get("refresh_token"),
                 "expires_in": oauth_credentials.credentials.get("expires_in", 3600),
                 "token_type": "Bearer",
+                "token_cache": oauth_credentials.credentials.get("token_cache"),
             }
             # Get user information from Microsoft Graph API
             user_info = await self.get_user_info(tokens["access_token"])
-            # Save credentials to database
-            user_id = credentials_db.save_user_credentials(user_info, tokens)
-            # Create a session token
-            session_token = credentials_db.create_session(user_id)
-            logger.info(f"Successfully saved credentials for user: {user_info.get('mail', 'unknown')}")
+            # Save credentials and create a session token in one transaction
+            user_id, session_token = await credentials_db.save_credentials_and_session_async(user_info, tokens)
+            logger.info("Successfully saved credentials for user: %s", user_info.get("mail", "unknown"))
             return {
                 "user_id": user_id,
                 "session_token": session_token,
@@ -62,31 +74,40 @@ class AuthService:
             }
 
         except Exception as e:
-            logger.error(f"OAuth callback failed: {e}")
+            logger.error("OAuth callback failed: %s", e)
             raise
 
     async def get_user_info(self, access_token: str) -> dict[str, Any]:
         """Get user information from Microsoft Graph API."""
+        key = token_key(access_token)
+        with _user_info_cache_lock:
+            cached = _user_info_cache.get(key)
+        if cached is not None:
+            return cached[1]
         try:
-            async with httpx.AsyncClient() as client:
-                headers = {"Authorization": f"Bearer {access_token}"}
-                response = await client.get("https://graph.microsoft.com/v1.0/me", headers=headers)
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.error(f"Failed to get user info: {response.status_code} {response.text}")
-                    return {"mail": "unknown@example.com", "displayName": "Unknown User"}
+            headers = {"Authorization": f"Bearer {access_token}"}
+            response = await graph_async_client.get(GRAPH_ME_URL, headers=headers)
+            if response.status_code == 200:
+                user_info = response.json()
+                with _user_info_cache_lock:
+                    _user_info_cache[key] = (token_exp(access_token), user_info)
+                return user_info
+            else:
+                logger.error("Failed to get user info: %s %s", response.status_code, response.text)
+                return {"mail": "unknown@example.com", "displayName": "Unknown User"}
         except Exception as e:
-            logger.error(f"Error getting user info: {e}")
+            logger.error("Error getting user info: %s", e)
             return {"mail": "unknown@example.com", "displayName": "Unknown User"}
 
-    async def refresh_access_token(self, refresh_token: str) -> dict[str, Any]:
-        """Refresh an expired access token."""
+    async def refresh_access_token(
+        self, refresh_token: str, token_cache: str | None = None, force_refresh: bool = False
+    ) -> dict[str, Any]:
+        """Refresh an expired access token; force_refresh always redeems the refresh token."""
         try:
-            credentials = {"refresh_token": refresh_token}
+            credentials = {"refresh_token": refresh_token, "token_cache": token_cache}
 
-            new_credentials = self.outlook_provider.oauth_refresh_credentials(
-                credentials=credentials
+            new_credentials = await asyncio.to_thread(
+                self.outlook_provider.oauth_refresh_credentials, credentials=credentials, force_refresh=force_refresh
             )
 
             logger.info("Successfully refreshed access token")
@@ -95,21 +116,22 @@ class AuthService:
                 "refresh_token": new_credentials.credentials.get("refresh_token"),
                 "expires_at": new_credentials.expires_at,
                 "token_type": "Bearer",
+                "token_cache": new_credentials.credentials.get("token_cache"),
             }
 
         except Exception as e:
-            logger.error(f"Token refresh failed: {e}")
+            logger.error("Token refresh failed: %s", e)
             raise
 
     async def validate_access_token(self, access_token: str) -> dict[str, bool]:
         """Validate an access token."""
         try:
             credentials = {"access_token": access_token}
-            self.outlook_provider._validate_credentials(credentials)
+            await self.outlook_provider._validate_credentials_async(credentials)
 
             logger.info("Access token validation successful")
             return {"valid": True}
 
         except Exception as e:
-            logger.error(f"Token validation failed: {e}")
+            logger.error("Token validation failed: %s", e)
             return {"valid": False}
@@ -2,24 +2,50 @@
 Email service for handling Microsoft Graph API operations.
 """
 
+import asyncio
 import logging
-from datetime import datetime
+import mimetypes
+from collections.abc import Iterable
+from operator import attrgetter
 from typing import Any
+from urllib.parse import quote
 
+import httpx
+import orjson
+from dify_plugin.entities.tool import ToolInvokeMessage
+
+from providers.outlook import graph_async_client
+from schemas.common_schemas import utc_timestamp
 from schemas.email_schemas import (
     AttachmentRequest,
+    BatchEmailOperation,
+    BatchOperation,
     CreateDraftRequest,
     ImportanceLevel,
     SendEmailRequest,
     UpdateEmailRequest,
 )
+from tools._http import GRAPH_BATCH_LIMIT
+from tools.delete_message import delete_message_tool
+from tools.draft_message import draft_message_tool
+from tools.get_message import get_message_tool
+from tools.list_message import list_message_tool
+from tools.prioritize_message_tool import prioritize_email_tool
+from tools.send_draft import send_draft_tool
+from tools.send_message import send_message_tool
+from tools.update_message import update_message_tool
 
 logger = logging.getLogger(__name__)
 
+# Tools only ever yield ToolInvokeMessage objects, so the payload is read without a fallback
+_message_payload = attrgetter("message")
+
 
 class EmailService:
     """Service class for email operations using Microsoft Graph API."""
 
+    __slots__ = ("base_url",)
+
     def __init__(self):
         self.base_url = "https://graph.microsoft.com/v1.0"
 
@@ -28,9 +54,6 @@ class EmailService:
     ) -> dict[str, Any]:
         """List emails from the specified folder with filtering."""
         try:
-            # Import here to avoid circular imports
-            from tools.list_message import list_message_tool
-
             # Convert request to tool parameters
             tool_parameters = {
                 "limit": limit,
@@ -44,44 +67,49 @@ class EmailService:
             # Call the existing tool
             invoke = list_message_tool.invoke(tool_parameters=tool_parameters)
 
-            emails = list(invoke)
+            result = self._extract_messages(invoke)
+            # Routers build the response with model_construct, so check the shape while debugging
+            assert isinstance(result, list), "list_emails must return a list"
 
-            result = self._extract_messages(emails)
-
-            logger.info(f"Listed emails from folder: {folder}")
+            logger.info("Listed emails from folder: %s", folder)
 
             return result
 
         except Exception as e:
-            logger.error(f"Failed to list emails: {e}")
+            logger.error("Failed to list emails: %s", e)
             raise
 
     async def get_email_by_id(self, access_token: str, message_id: str) -> dict[str, Any]:
         """Get a specific email by its ID."""
         try:
-            from tools.get_message import get_message_tool
-
             tool_parameters = {"message_id": message_id, "access_token": access_token}
 
             result = get_message_tool.invoke(tool_parameters=tool_parameters)
 
-            logger.info(f"Retrieved email with ID: {message_id}")
+            logger.info("Retrieved email with ID: %s", message_id)
             return result
 
         except Exception as e:
-            logger.error(f"Failed to get email {message_id}: {e}")
+            logger.error("Failed to get email %s: %s", message_id, e)
             raise
 
+    async def stream_email(self, headers: dict[str, str], message_id: str) -> httpx.Response:
+        """Open a streaming Graph response for an email; the caller must close it."""
+        request = graph_async_client.build_request(
+            "GET", f"{self.base_url}/me/messages/{quote(message_id, safe='')}", headers=headers
+        )
+        response = await graph_async_client.send(request, stream=True)
+        if response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+            raise Exception(f"API error {response.status_code}: {response.text}")
+        return response
+
     async def send_email(self, access_token: str, request: SendEmailRequest) -> dict[str, Any]:
         """Send an email."""
         try:
-            from tools.send_message import send_message_tool
-
-            # Convert recipients list to comma-separated string
-            to_recipients = ",".join(request.to)
-
             tool_parameters = {
-                "to": to_recipients,
+                "to": request.to,
                 "subject": request.subject,
                 "message": request.body,
                 "access_token": access_token,
@@ -89,18 +117,16 @@ class EmailService:
 
             result = send_message_tool.invoke(tool_parameters=tool_parameters)
 
-            logger.info(f"Sent email to {len(request.to)} recipients")
+            logger.info("Sent email to %s recipients", request.to.count(",") + 1)
             return result
 
         except Exception as e:
-            logger.error(f"Failed to send email: {e}")
+            logger.error("Failed to send email: %s", e)
             raise
 
     async def create_draft(self, access_token: str, request: CreateDraftRequest) -> dict[str, Any]:
         """Create a draft email."""
         try:
-            from tools.draft_message import draft_message_tool
-
             tool_parameters = {
                 "subject": request.subject,
                 "body": request.body,
@@ -113,22 +139,18 @@ class EmailService:
 
             invoke = draft_message_tool.invoke(tool_parameters=tool_parameters)
 
-            # The invoke method returns a generator, so we need to consume it
-            messages = list(invoke)
+            # The tool makes its Graph call before its first yield, so only that message is read
+            result = self._extract_result(invoke)
 
-            result = self._extract_result(messages)
-
-            return {"result": result, "created_at": datetime.utcnow().isoformat() + "Z"}
+            return {"result": result, "created_at": utc_timestamp()}
 
         except Exception as e:
-            logger.error(f"Failed to create draft: {e}")
+            logger.error("Failed to create draft: %s", e)
             raise
 
     async def update_email(self, access_token: str, email_id: str, request: UpdateEmailRequest) -> dict[str, Any]:
         """Update an existing email."""
         try:
-            from tools.update_message import update_message_tool
-
             tool_parameters = {
                 "email_id": email_id,
                 "subject": request.subject,
@@ -139,15 +161,13 @@ class EmailService:
 
             invoke = update_message_tool.invoke(tool_parameters=tool_parameters)
 
-            # The invoke method returns a generator, so we need to consume it
-            messages = list(invoke)
+            # The tool makes its Graph call before its first yield, so only that message is read
+            result = self._extract_result(invoke)
 
-            result = self._extract_result(messages)
-
-            return {"result": result, "updated_at": datetime.utcnow().isoformat() + "Z"}
+            return {"result": result, "updated_at": utc_timestamp()}
 
         except Exception as e:
-            logger.error(f"Failed to update email {email_id}: {e}")
+            logger.error("Failed to update email %s: %s", email_id, e)
             raise
 
     async def add_attachment_to_draft(
@@ -155,38 +175,48 @@ class EmailService:
     ) -> dict[str, Any]:
         """Add attachment to a draft email."""
         try:
-            from tools.add_attachment_to_draft import add_attachment_to_draft_tool
-
-            tool_parameters = {
-                "draft_id": draft_id,
-                "file_to_attach": [request.file_content],
+            # Graph takes contentBytes as base64, so the request payload is forwarded without decoding it
+            attachment = {
+                "@odata.type": "#microsoft.graph.fileAttachment",
+                "name": request.file_name,
+                "contentType": request.content_type
+                or mimetypes.guess_type(request.file_name)[0]
+                or "application/octet-stream",
+                "contentBytes": request.file_content,
+            }
+            response = await graph_async_client.post(
+                f"{self.base_url}/me/messages/{quote(draft_id, safe='')}/attachments",
+                json=attachment,
+                headers={"Authorization": f"Bearer {access_token}"},
+            )
+            if response.status_code not in (200, 201):
+                raise Exception(f"API error {response.status_code}: {response.text}")
+            result = orjson.loads(response.content)
+
+            logger.info("Added attachment to draft %s", draft_id)
+            return {
+                "result": result,
+                "attachment_id": result.get("id"),
                 "attachment_name": request.file_name,
-                "access_token": access_token,
+                "operation": "added",
             }
 
-            result = add_attachment_to_draft_tool.invoke(tool_parameters=tool_parameters)
-
-            logger.info(f"Added attachment to draft {draft_id}")
-            return {"result": result, "attachment_name": request.file_name, "operation": "added"}
-
         except Exception as e:
-            logger.error(f"Failed to add attachment to draft {draft_id}: {e}")
+            logger.error("Failed to add attachment to draft %s: %s", draft_id, e)
             raise
 
     async def send_draft(self, access_token: str, draft_id: str) -> dict[str, Any]:
         """Send a draft email."""
         try:
-            from tools.send_draft import send_draft_tool
-
             tool_parameters = {"draft_id": draft_id, "access_token": access_token}
 
             result = send_draft_tool.invoke(tool_parameters=tool_parameters)
 
-            logger.info(f"Sent draft email {draft_id}")
-            return {"result": result, "sent_at": datetime.utcnow().isoformat() + "Z"}
+            logger.info("Sent draft email %s", draft_id)
+            return {"result": result, "sent_at": utc_timestamp()}
 
         except Exception as e:
-            logger.error(f"Failed to send draft {draft_id}: {e}")
+            logger.error("Failed to send draft %s: %s", draft_id, e)
             raise
 
     async def prioritize_email(
@@ -194,8 +224,6 @@ class EmailService:
     ) -> dict[str, Any]:
         """Set the priority/importance level of an email."""
         try:
-            from tools.prioritize_message_tool import prioritize_email_tool
-
             tool_parameters = {
                 "email_id": email_id,
                 "priority_level": priority_level.value,
@@ -204,66 +232,98 @@ class EmailService:
 
             result = prioritize_email_tool.invoke(tool_parameters=tool_parameters)
 
-            logger.info(f"Set priority for email {email_id} to {priority_level.value}")
+            logger.info("Set priority for email %s to %s", email_id, priority_level.value)
             return {
                 "result": result,
                 "priority_level": priority_level.value,
-                "updated_at": datetime.utcnow().isoformat() + "Z",
+                "updated_at": utc_timestamp(),
             }
 
         except Exception as e:
-            logger.error(f"Failed to prioritize email {email_id}: {e}")
+            logger.error("Failed to prioritize email %s: %s", email_id, e)
             raise
 
     async def delete_email(self, access_token: str, message_id: str) -> dict[str, Any]:
         """Delete an email by its ID."""
         try:
-            from tools.delete_message import delete_message_tool
-
             tool_parameters = {"message_id": message_id, "access_token": access_token}
 
             invoke = delete_message_tool.invoke(tool_parameters=tool_parameters)
 
-            # The invoke method returns a generator, so we need to consume it
-            messages = list(invoke)
+            # The tool makes its Graph call before its first yield, so only that message is read
+            result = self._extract_result(invoke)
 
-            result = self._extract_result(messages)
+            logger.info("Deleted email with ID: %s", message_id)
+            return {"result": result, "deleted_at": utc_timestamp()}
 
-            logger.info(f"Deleted email with ID: {message_id}")
-            return {"result": result, "deleted_at": datetime.utcnow().isoformat() + "Z"}
+        except Exception as e:
+            logger.error("Failed to delete email %s: %s", message_id, e)
+            raise
+
+    async def batch_emails(self, headers: dict[str, str], operations: list[BatchEmailOperation]) -> list[dict[str, Any]]:
+        """Apply several email operations through Graph JSON batching."""
+        try:
+            graph_requests = [self._build_graph_subrequest(str(i), op) for i, op in enumerate(operations)]
+            chunks = [
+                graph_requests[i : i + GRAPH_BATCH_LIMIT] for i in range(0, len(graph_requests), GRAPH_BATCH_LIMIT)
+            ]
+            responses = await asyncio.gather(
+                *(
+                    graph_async_client.post(f"{self.base_url}/$batch", json={"requests": chunk}, headers=headers)
+                    for chunk in chunks
+                )
+            )
+
+            results: list[dict[str, Any]] = [{} for _ in operations]
+            for response in responses:
+                response.raise_for_status()
+                for item in orjson.loads(response.content).get("responses", []):
+                    index = int(item["id"])
+                    results[index] = {
+                        "email_id": operations[index].email_id,
+                        "operation": operations[index].operation.value,
+                        "status": item.get("status"),
+                        "body": item.get("body"),
+                    }
+
+            logger.info("Ran %s email operations in %s batch request(s)", len(operations), len(chunks))
+            return results
 
         except Exception as e:
-            logger.error(f"Failed to delete email {message_id}: {e}")
+            logger.error("Failed to run batch email operations: %s", e)
             raise
 
-    def _extract_result(self, messages: list[Any]) -> str:
-        """Extract the result from the list of messages."""
-        # Extract the actual result from the ToolInvokeMessage objects
-        if messages:
-            first_message = messages[0]
-            if hasattr(first_message, "message"):
-                # Extract the message content from ToolInvokeMessage
-                if hasattr(first_message.message, "text"):
-                    result = first_message.message.text
-                else:
-                    result = str(first_message.message)
-            else:
-                result = str(first_message)
+    def _build_graph_subrequest(self, request_id: str, operation: BatchEmailOperation) -> dict[str, Any]:
+        """Translate an email operation into a Graph $batch sub-request."""
+        url = f"/me/messages/{quote(operation.email_id, safe='')}"
+        if operation.operation == BatchOperation.DELETE:
+            return {"id": request_id, "method": "DELETE", "url": url}
+
+        if operation.operation == BatchOperation.MARK_READ:
+            body = {"isRead": operation.is_read}
         else:
-            result = "No result returned"
-
-        return result
-
-    def _extract_messages(self, messages: list[Any]) -> list[Any]:
-        """Extract the messages from the list of messages."""
-        # Extract the actual messages from the list of ToolInvokeMessage objects
-        extracted_messages = []
-        for msg in messages:
-            if hasattr(msg, "message"):
-                extracted_messages.append(msg.message)
-            else:
-                extracted_messages.append(msg)
-        return extracted_messages
+            body = {"importance": operation.priority_level.value}
+        return {
+            "id": request_id,
+            "method": "PATCH",
+            "url": url,
+            "body": body,
+            "headers": {"Content-Type": "application/json"},
+        }
+
+    def _extract_result(self, messages: Iterable[ToolInvokeMessage]) -> str:
+        """Extract the text of the first tool message, without consuming the rest."""
+        first_message = next(iter(messages), None)
+        if first_message is None:
+            return "No result returned"
+        payload = first_message.message
+        # Text messages carry .text; JSON and other payloads fall back to their repr
+        text = getattr(payload, "text", None)
+        return text if text is not None else str(payload)
+
+    def _extract_messages(self, messages: Iterable[ToolInvokeMessage]) -> list[Any]:
+        """Extract the message payloads from a stream of ToolInvokeMessage objects."""
+        return list(map(_message_payload, messages))
 
 
 email_service = EmailService()
@@ -76,7 +76,7 @@ echo "🎉 PostgreSQL setup complete!"
 echo ""
 echo "📋 Next steps:"
 echo "1. Update your .env file with Azure credentials"
-echo "2. Start the API server: .venv/bin/python -m uvicorn main:app --reload --ssl-keyfile=certs/key.pem --ssl-certfile=certs/cert.pem"
+echo "2. Start the API server: .venv/bin/python -m uvicorn main:app --reload --loop asyncio --http httptools --ssl-keyfile=certs/key.pem --ssl-certfile=certs/cert.pem"
 echo "3. Visit: https://localhost:8000/client"
 echo ""
 echo "🛠️  Database Management:"
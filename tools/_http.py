@@ -0,0 +1,182 @@
+"""
+Shared HTTP session for the Microsoft Graph tools.
+"""
+
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from collections.abc import Mapping
+from typing import Any
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.tokens import token_exp
+
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+# Microsoft Graph accepts at most 20 sub-requests per $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# Fail fast on a hung Graph endpoint instead of holding a plugin worker indefinitely
+GRAPH_CONNECT_TIMEOUT = 3.05
+GRAPH_READ_TIMEOUT = 15.0
+GRAPH_TIMEOUT = (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT)
+
+# Retry throttling and gateway errors with jittered exponential backoff, honouring Graph's Retry-After.
+# PATCH is added to urllib3's idempotent defaults (messages are patched to a fixed end state); POST is
+# never retried, so a send can't be duplicated.
+GRAPH_RETRY = Retry(
+    total=3,
+    backoff_factor=1.0,
+    backoff_max=30,
+    backoff_jitter=0.5,
+    status_forcelist=(429, 502, 503, 504),
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"},
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+
+class GraphError(Exception):
+    """A Graph call from a tool failed; the message is ready to show to the user."""
+
+
+class CircuitOpenError(GraphError):
+    """Raised instead of sending a request while graph_breaker is open."""
+
+
+class _CircuitBreaker:
+    """Consecutive-failure circuit breaker whose lock only guards its state, never the request itself."""
+
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        # Once reset_timeout has passed, a single probe request is let through before the breaker closes again
+        self._probing = False
+
+    @property
+    def current_state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError if the breaker is open, or half-open with its probe already in flight."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("Graph API temporarily unavailable; try again shortly.")
+            self._probing = True
+
+    def after_call(self, success: bool | None) -> None:
+        """Record a call's outcome; None means it ended without telling us anything about Graph."""
+        with self._lock:
+            self._probing = False
+            if success:
+                self._failures = 0
+                self._opened_at = None
+            elif success is not None:
+                self._failures += 1
+                if self._opened_at is not None or self._failures >= self.fail_max:
+                    self._opened_at = time.monotonic()
+
+
+# Open after 5 consecutive Graph failures and refuse calls for 30s, so an outage costs microseconds per
+# call instead of a full connect/read timeout. Only 5xx responses, timeouts and connection errors count.
+graph_breaker = _CircuitBreaker(fail_max=5, reset_timeout=30)
+
+
+class _GraphSession(requests.Session):
+    """Session whose requests are gated by graph_breaker; the network I/O itself runs outside its lock."""
+
+    def request(self, method, url, *args, **kwargs):
+        graph_breaker.before_call()
+        success = None
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            success = response.status_code < 500
+            return response
+        except requests.RequestException:
+            success = False
+            raise
+        finally:
+            graph_breaker.after_call(success)
+
+
+def _build_session(adapter: HTTPAdapter) -> _GraphSession:
+    """Create a Graph session that sends every HTTPS request through the given adapter."""
+    session = _GraphSession()
+    session.mount("https://", adapter)
+    # Only token-independent headers live on the shared session; the bearer token stays per call so
+    # concurrent invocations for different users can never pick up each other's credentials
+    session.headers["Accept"] = "application/json"
+    return session
+
+
+# Reads and writes get separate keep-alive pools (bulkheads), so a burst of slow PATCH/POST bodies can't hold
+# the sockets deletes and reads need. Writes block on their own capped pool rather than opening more sockets.
+_WRITE_METHODS = frozenset({"PATCH", "POST", "PUT"})
+_read_session = _build_session(HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=GRAPH_RETRY))
+_write_session = _build_session(
+    HTTPAdapter(pool_connections=10, pool_maxsize=10, pool_block=True, max_retries=GRAPH_RETRY)
+)
+
+
+def get_session(method: str = "GET") -> requests.Session:
+    """Return the shared Graph session for an HTTP method's pool."""
+    return _write_session if method in _WRITE_METHODS else _read_session
+
+
+def auth_headers(access_token: str) -> dict[str, str]:
+    """Return the per-call headers for a bodiless Graph request."""
+    # urllib3 resends the same headers on every retry, so Graph sees all attempts under one client-request-id
+    return {"Authorization": f"Bearer {access_token}", "client-request-id": str(uuid.uuid4())}
+
+
+def json_headers(access_token: str) -> dict[str, str]:
+    """Return the per-call headers for a Graph request whose body is pre-serialized JSON."""
+    return {**auth_headers(access_token), "Content-Type": "application/json"}
+
+
+# Graph IDs are URL-safe base64, so quoting is almost always a no-op; '=' padding is legal in a path segment
+_URL_SAFE_ID = re.compile(r"[A-Za-z0-9_.~=-]*").fullmatch
+
+
+def quote_id(value: str) -> str:
+    """Quote a Graph resource ID for use as a single path segment, skipping the copy when it is already safe."""
+    if _URL_SAFE_ID(value):
+        return value
+    return urllib.parse.quote(value, safe="=")
+
+
+def get_valid_token(tool_parameters: Mapping[str, Any]) -> str | None:
+    """Return the caller's access token, or None if it is missing or its exp claim has already passed."""
+    access_token = tool_parameters.get("access_token")
+    if not access_token:
+        return None
+    # Refreshing is the caller's job; an expired token only needs a local check to skip a doomed Graph call
+    exp = token_exp(access_token)
+    if exp is not None and exp <= time.time():
+        return None
+    return access_token
+
+
+def graph_batch(session: requests.Session, access_token: str, requests_list: list[dict[str, Any]]) -> dict[str, dict]:
+    """Send up to GRAPH_BATCH_LIMIT sub-requests in one $batch envelope and return the responses by id."""
+    response = session.post(
+        GRAPH_BATCH_URL,
+        headers=json_headers(access_token),
+        data=orjson.dumps({"requests": requests_list}),
+        timeout=GRAPH_TIMEOUT,
+    )
+    response.raise_for_status()
+    return {item["id"]: item for item in orjson.loads(response.content).get("responses", [])}
@@ -1,10 +1,26 @@
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 import requests
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
+from tools._http import (
+    GRAPH_BATCH_LIMIT,
+    GRAPH_TIMEOUT,
+    CircuitOpenError,
+    GraphError,
+    auth_headers,
+    get_session,
+    get_valid_token,
+    graph_batch,
+    quote_id,
+)
+
+# $batch envelopes in flight at once; kept under the session pool size and gentle on Graph throttling
+BULK_DELETE_CONCURRENCY = 10
+
 
 class DeleteEmailTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
@@ -14,28 +30,39 @@ class DeleteEmailTool(Tool):
         try:
             # Get parameters
             message_id = tool_parameters.get("message_id")
+            message_ids = self._parse_message_ids(tool_parameters.get("message_ids"))
 
-            if not message_id:
+            if not message_id and not message_ids:
                 yield self.create_text_message("Message ID is required.")
                 return
 
             # Get access token from OAuth credentials
-            access_token = tool_parameters.get("access_token")
+            access_token = get_valid_token(tool_parameters)
             if not access_token:
-                yield self.create_text_message("Access token is required in credentials.")
+                yield self.create_text_message("A valid, unexpired access token is required in credentials.")
+                return
+
+            if message_ids:
+                try:
+                    results = self._delete_emails_bulk(access_token, message_ids)
+                    failed = {mid: str(error) for mid, error in results.items() if error is not None}
+                    deleted = len(results) - len(failed)
+                    yield self.create_text_message(f"Deleted {deleted} of {len(results)} emails.")
+                    yield self.create_json_message({"deleted": deleted, "failed": failed})
+                except Exception as e:
+                    yield self.create_text_message(f"Error deleting emails: {str(e)}")
                 return
 
             try:
                 # Delete email
-                response = self._delete_email(access_token, message_id)
-
-                if isinstance(response, str):  # Error message
-                    yield self.create_text_message(response)
-                    return
+                self._delete_email(access_token, message_id)
 
                 # Success: return confirmation message
                 yield self.create_text_message(f"Email with ID {message_id} deleted successfully.")
                 return
+            except GraphError as e:
+                yield self.create_text_message(str(e))
+                return
             except Exception as e:
                 yield self.create_text_message(f"Error deleting email: {str(e)}")
                 return
@@ -44,23 +71,69 @@ class DeleteEmailTool(Tool):
             yield self.create_text_message(f"Error: {str(e)}")
             return
 
-    def _delete_email(self, access_token: str, message_id: str):
+    def _delete_email(self, access_token: str, message_id: str) -> None:
         """
-        Delete an email using Microsoft Graph API
+        Delete an email using Microsoft Graph API, raising GraphError on failure
         """
+        url = f"https://graph.microsoft.com/v1.0/me/messages/{quote_id(message_id)}"
         try:
-            url = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}"
-            headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+            response = get_session().delete(url, headers=auth_headers(access_token), timeout=GRAPH_TIMEOUT)
+        except requests.Timeout as e:
+            raise GraphError("Graph API timed out while deleting the email.") from e
+        except requests.RequestException as e:
+            raise GraphError(f"Network error during deletion: {str(e)}") from e
 
-            response = requests.delete(url, headers=headers)
+        if response.status_code != 204:
+            raise GraphError(f"Failed to delete email: {response.text}")
 
-            if response.status_code == 204:
-                return {"status": "success", "message": f"Email with ID {message_id} deleted."}
-            else:
-                return f"Failed to delete email: {response.text}"
+    def _delete_emails_bulk(self, access_token: str, message_ids: list[str]) -> dict[str, GraphError | None]:
+        """
+        Delete several emails through Graph $batch, sending the envelopes concurrently.
+        Maps each message ID to None if it was deleted, or to the GraphError explaining why not.
+        """
+        chunks = [message_ids[i : i + GRAPH_BATCH_LIMIT] for i in range(0, len(message_ids), GRAPH_BATCH_LIMIT)]
+        with ThreadPoolExecutor(max_workers=min(BULK_DELETE_CONCURRENCY, len(chunks))) as executor:
+            results: dict[str, GraphError | None] = {}
+            for chunk_results in executor.map(lambda chunk: self._delete_email_batch(access_token, chunk), chunks):
+                results.update(chunk_results)
+            return results
 
+    def _delete_email_batch(self, access_token: str, message_ids: list[str]) -> dict[str, GraphError | None]:
+        """
+        Delete up to GRAPH_BATCH_LIMIT emails in a single $batch round-trip
+        """
+        requests_list = [
+            {"id": str(i), "method": "DELETE", "url": f"/me/messages/{quote_id(message_id)}"}
+            for i, message_id in enumerate(message_ids)
+        ]
+        try:
+            responses = graph_batch(get_session("POST"), access_token, requests_list)
+        except CircuitOpenError as e:
+            return dict.fromkeys(message_ids, e)
+        except requests.Timeout:
+            return dict.fromkeys(message_ids, GraphError("Graph API timed out while deleting the emails."))
         except requests.RequestException as e:
-            return f"Network error during deletion: {str(e)}"
+            return dict.fromkeys(message_ids, GraphError(f"Network error during deletion: {str(e)}"))
+
+        results: dict[str, GraphError | None] = {}
+        for i, message_id in enumerate(message_ids):
+            item = responses.get(str(i), {})
+            if item.get("status") == 204:
+                results[message_id] = None
+            else:
+                results[message_id] = GraphError(f"Failed to delete email: {item.get('body')}")
+        return results
+
+    @staticmethod
+    def _parse_message_ids(value: Any) -> list[str]:
+        """
+        Accept message IDs as a list or a comma-separated string, dropping blanks and duplicates
+        """
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = value.split(",")
+        return list(dict.fromkeys(str(message_id).strip() for message_id in value if str(message_id).strip()))
 
 
 delete_message_tool = DeleteEmailTool(
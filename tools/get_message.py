@@ -2,6 +2,7 @@ import urllib.parse
 from collections.abc import Generator
 from typing import Any
 
+import orjson
 import requests
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
@@ -63,7 +64,7 @@ class GetMessageTool(Tool):
             elif response.status_code != 200:
                 raise Exception(f"API error {response.status_code}: {response.text}")
 
-            message_data = response.json()
+            message_data = orjson.loads(response.content)
 
             # Format response
             result = {
@@ -104,7 +105,7 @@ class GetMessageTool(Tool):
             response = requests.get(url, headers=headers, timeout=30)
 
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 return [
                     {
                         "id": a.get("id"),
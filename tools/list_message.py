@@ -1,11 +1,22 @@
+import threading
 from collections.abc import Generator
 from datetime import datetime
 from typing import Any
 
+import orjson
 import requests
+from cachetools import TTLCache
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
+from tools._http import GRAPH_TIMEOUT, CircuitOpenError, auth_headers, get_session
+from utils.hashing import token_key
+
+# (ETag, formatted emails) of recent listings, so repeated polls can be answered with a 304.
+# Keys hold the access token's token_key digest rather than the token itself.
+_listing_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_listing_cache_lock = threading.Lock()
+
 
 class ListEmailsTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
@@ -116,13 +127,25 @@ class ListEmailsTool(Tool):
 
             # Set headers
             headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
+                **auth_headers(access_token),
                 "ConsistencyLevel": "eventual",  # Required for search
             }
 
+            cache_key = (
+                token_key(access_token),
+                base_url,
+                tuple(sorted(params.items())),
+            )
+            with _listing_cache_lock:
+                cached = _listing_cache.get(cache_key)
+            if cached:
+                headers["If-None-Match"] = cached[0]
+
             # Make API request
-            response = requests.get(base_url, headers=headers, params=params, timeout=30)
+            response = get_session().get(base_url, headers=headers, params=params, timeout=GRAPH_TIMEOUT)
+
+            if response.status_code == 304 and cached:
+                return cached[1]
 
             # Handle response
             if response.status_code == 401:
@@ -134,7 +157,7 @@ class ListEmailsTool(Tool):
             elif response.status_code != 200:
                 return f"API error {response.status_code}: {response.text}"
 
-            data = response.json()
+            data = orjson.loads(response.content)
             messages = data.get("value", [])
 
             # Format messages
@@ -143,8 +166,17 @@ class ListEmailsTool(Tool):
                 email_data = self._format_email(msg, include_body)
                 formatted_emails.append(email_data)
 
+            etag = response.headers.get("ETag")
+            if etag:
+                with _listing_cache_lock:
+                    _listing_cache[cache_key] = (etag, formatted_emails)
+
             return formatted_emails
 
+        except CircuitOpenError as e:
+            return str(e)
+        except requests.exceptions.Timeout:
+            return "Graph API timed out while listing emails."
         except requests.exceptions.RequestException as e:
             return f"Network error: {str(e)}"
         except Exception as e:
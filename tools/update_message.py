@@ -1,11 +1,19 @@
-import urllib.parse
 from collections.abc import Generator
 from typing import Any
 
+import orjson
 import requests
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
+from tools._http import GRAPH_TIMEOUT, GraphError, get_session, get_valid_token, json_headers, quote_id
+
+# Fixed messages for Graph error statuses; 404 names the email and anything else reports the raw error
+_UPDATE_ERRORS = {
+    401: "Authentication failed. Token may be expired.",
+    403: "Access denied. Check app permissions (Mail.ReadWrite required).",
+}
+
 
 class UpdateMessageTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
@@ -29,23 +37,22 @@ class UpdateMessageTool(Tool):
                 return
 
             # Get access token from OAuth credentials
-            access_token = tool_parameters.get("access_token")
+            access_token = get_valid_token(tool_parameters)
             if not access_token:
-                yield self.create_text_message("Access token is required in credentials.")
+                yield self.create_text_message("A valid, unexpired access token is required in credentials.")
                 return
 
             try:
                 # Update email message
                 result = self._update_email_message(access_token, email_id, subject, body_content, body_type)
 
-                if isinstance(result, str):  # Error message
-                    yield self.create_text_message(result)
-                    return
-
                 # Success
                 yield self.create_text_message("Email updated successfully!")
                 yield self.create_json_message(result)
 
+            except GraphError as e:
+                yield self.create_text_message(str(e))
+                return
             except Exception as e:
                 yield self.create_text_message(f"Error updating email: {str(e)}")
                 return
@@ -54,34 +61,39 @@ class UpdateMessageTool(Tool):
             yield self.create_text_message(f"Error: {str(e)}")
             return
 
-    def _update_email_message(self, access_token: str, email_id: str, subject: str, body_content: str, body_type: str):
+    def _update_email_message(
+        self, access_token: str, email_id: str, subject: str, body_content: str, body_type: str
+    ) -> dict[str, Any]:
         """
-        Update email message using Microsoft Graph API
+        Update email message using Microsoft Graph API, raising GraphError on failure
         """
-        try:
-            url = f"https://graph.microsoft.com/v1.0/me/messages/{urllib.parse.quote(email_id)}"
-
-            headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+        url = f"https://graph.microsoft.com/v1.0/me/messages/{quote_id(email_id)}"
 
-            data = {"subject": subject, "body": {"contentType": body_type, "content": body_content}}
-
-            response = requests.patch(url, headers=headers, json=data)
-
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 401:
-                return "Authentication failed. Token may be expired."
-            elif response.status_code == 403:
-                return "Access denied. Check app permissions (Mail.ReadWrite required)."
-            elif response.status_code == 404:
-                return f"Email with ID '{email_id}' not found."
-            else:
-                return f"API error {response.status_code}: {response.text}"
+        # Only send the fields being changed; an empty subject or body would otherwise blank it in Graph
+        data: dict[str, Any] = {}
+        if subject:
+            data["subject"] = subject
+        if body_content:
+            data["body"] = {"contentType": body_type, "content": body_content}
 
+        try:
+            response = get_session("PATCH").patch(
+                url, headers=json_headers(access_token), data=orjson.dumps(data), timeout=GRAPH_TIMEOUT
+            )
+        except requests.exceptions.Timeout as e:
+            raise GraphError("Graph API timed out while updating the email.") from e
         except requests.exceptions.RequestException as e:
-            return f"Network error: {str(e)}"
-        except Exception as e:
-            return f"Error updating email: {str(e)}"
+            raise GraphError(f"Network error: {str(e)}") from e
+
+        if response.status_code == 200:
+            try:
+                return orjson.loads(response.content)
+            except orjson.JSONDecodeError as e:
+                raise GraphError(f"Error updating email: {str(e)}") from e
+        if response.status_code == 404:
+            raise GraphError(f"Email with ID '{email_id}' not found.")
+        error = _UPDATE_ERRORS.get(response.status_code)
+        raise GraphError(error if error is not None else f"API error {response.status_code}: {response.text}")
 
 
 update_message_tool = UpdateMessageTool(
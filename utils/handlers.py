@@ -0,0 +1,31 @@
+"""
+Route handler helpers shared by the API routers.
+"""
+
+import functools
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+def graph_endpoint(error_message: str, status_code: int = 500):
+    """Log unexpected errors from a route and turn them into an HTTPException."""
+
+    def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except HTTPException:
+                raise
+            except Exception as e:
+                logger.error("%s (%s): %s", error_message, func.__name__, e)
+                raise HTTPException(status_code=status_code, detail=f"{error_message}: {str(e)}")
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,14 @@
+"""
+Cache-key hashing for bearer tokens held in in-process caches.
+"""
+
+import hashlib
+import secrets
+
+# Per-process key, so digests can't be precomputed or compared across processes
+_TOKEN_KEY_SECRET = secrets.token_bytes(32)
+
+
+def token_key(token: str) -> bytes:
+    """Return a fixed 16-byte keyed digest of a token for use as a cache key."""
+    return hashlib.blake2b(token.encode(), digest_size=16, key=_TOKEN_KEY_SECRET).digest()
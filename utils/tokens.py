@@ -0,0 +1,32 @@
+"""
+Unverified reads of OAuth access token claims.
+"""
+
+import base64
+import binascii
+import json
+import time
+
+# Entries derived from a token Graph accepted are kept this long, and dropped 30s before the token expires
+VALIDATION_CACHE_TTL = 300
+VALIDATION_EXPIRY_MARGIN = 30
+# Access tokens with less than this many seconds left are refreshed rather than used or handed out again
+TOKEN_REFRESH_THRESHOLD = 300
+
+
+def token_exp(access_token: str) -> float | None:
+    """Read the unverified exp claim of a JWT access token, or None if it is opaque."""
+    try:
+        payload = access_token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError, binascii.Error):
+        return None
+
+
+def validated_ttu(_key: bytes, entry: tuple, now: float) -> float:
+    """TLRUCache ttu keeping an entry whose first item is the token's exp for VALIDATION_CACHE_TTL, never up to it."""
+    exp = entry[0]
+    if exp is None:
+        return now + VALIDATION_CACHE_TTL
+    return now + min(VALIDATION_CACHE_TTL, exp - VALIDATION_EXPIRY_MARGIN - time.time())